@@ -17,26 +17,33 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import Any, Callable, List, Optional, Set, Union, TYPE_CHECKING
+from typing import Any, Awaitable, Callable, Iterator, List, Optional, Sequence, Set, Tuple, Union, TYPE_CHECKING
 
 import os
+import time
 import asyncio
 import aiohttp
-import itertools
 import contextlib
 import logging
 
 import discord
 from discord.ext import commands
 
-from aperture.core import listeners, constants, ApertureContext
+from aperture.core import listeners, constants, ApertureContext, ApertureMetrics, ApertureMigrator
+from aperture.core.metrics import Counter, Gauge, HistogramMetric, Metric, MetricsServer
+from aperture.core.timings import CommandTiming, PipelineTimings, current_timing
+from aperture.core.tracing import tracer
+from aperture.core.watchdog import LoopWatchdog
+from aperture.core.cache.prefix import compile_prefix
 from aperture.management import ApertureManagementWebhookClient
 
 
 log = logging.getLogger(__name__)
 
+InvokeHook = Callable[[ApertureContext], Awaitable[None]]
 
-class ApertureBot(commands.Bot):
+
+class ApertureBot(commands.AutoShardedBot):
     if TYPE_CHECKING:
         import asyncpg
         from ..launcher import VersionInfo
@@ -48,7 +55,13 @@ class ApertureBot(commands.Bot):
         cache: ApertureCache
         webhook_client: ApertureManagementWebhookClient
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        *,
+        shard_ids: Optional[Sequence[int]] = None,
+        shard_count: Optional[int] = None,
+        worker_id: Optional[int] = None
+    ) -> None:
         activity = discord.Activity(type = discord.ActivityType.listening, name='@Aperture help')
         allowed_mentions = discord.AllowedMentions(
             everyone = False,
@@ -82,6 +95,8 @@ class ApertureBot(commands.Bot):
             intents = intents,
             max_messages = None,
             member_cache_flags = member_cache_flags,
+            shard_count = shard_count,
+            shard_ids = list(shard_ids) if shard_ids is not None else None,
             strip_after_prefix = True,
         )
         log.debug('Initialised the Bot class')
@@ -89,35 +104,69 @@ class ApertureBot(commands.Bot):
         self._BotBase__cogs = commands.core._CaseInsensitiveDict()
 
         self.ready: bool = False
+        # Index of this process in cluster mode
+        self.worker_id: Optional[int] = worker_id
         self._default_prefix: str = constants.DEFAULT_PREFIX
         self.http_session: Optional[aiohttp.ClientSession] = None
+        # ``<@id>`` and ``<@!id>``, set once the bot user is known
+        self._mention_prefixes: Tuple[str, ...] = ()
+
+        self.metrics = ApertureMetrics()
+        self.metrics.add_collector(self._collect_metrics)
+        self._commands_invoked = self.metrics.counter(
+            'aperture_commands_total', 'Commands invoked', ('command', )
+        )
+        self._command_duration = self.metrics.histogram(
+            'aperture_command_duration_seconds', 'Time taken to invoke a command, checks included', ('command', )
+        )
+        self._blacklist_rejections = self.metrics.counter(
+            'aperture_blacklist_rejections_total', 'Messages ignored because the guild or user is blacklisted', ('scope', )
+        )
+        # Stage by stage timings of the command pipeline, off unless COMMAND_TIMINGS is true
+        self.pipeline_timings: Optional[PipelineTimings] = None
+        # (previous before invoke hook, previous after invoke hook, our before hook, our after hook) while enabled
+        self._timing_hooks: Optional[Tuple[Optional[InvokeHook], ...]] = None
+        if os.getenv('COMMAND_TIMINGS', 'false').lower() == 'true':
+            self.enable_timings()
+
+        # Sampled traces of the commands, off unless TRACE_SAMPLE_RATE is above 0
+        tracer.configure(
+            os.getenv('TRACE_PATH', './tmp/traces.json'), float(os.getenv('TRACE_SAMPLE_RATE') or 0), worker_id=worker_id
+        )
+
+        # Samples the stack of whatever blocks the event loop longer than LOOP_LAG_THRESHOLD (0 to disable)
+        lag_threshold = float(os.getenv('LOOP_LAG_THRESHOLD', 0.25))
+        self.watchdog: Optional[LoopWatchdog] = LoopWatchdog(threshold=lag_threshold) if lag_threshold > 0 else None
+
+        # Only served when METRICS_PORT is set, cluster workers serve on METRICS_PORT + worker id
+        metrics_port = int(os.getenv('METRICS_PORT') or 0)
+        if metrics_port and worker_id is not None:
+            metrics_port += worker_id
+        self.metrics_server: Optional[MetricsServer] = MetricsServer(
+            self.metrics, host=os.getenv('METRICS_HOST', '127.0.0.1'), port=metrics_port
+        ) if metrics_port else None
 
         # Tasks to execute after bot gets ready
         self.loop.create_task(self.initialise_after_run())
 
 
-    @staticmethod
-    def _get_case_insensitive_prefixes(prefix: str) -> List[str]:
-        return list(map(''.join, itertools.product(*zip(prefix.lower(), prefix.upper()))))
-
     async def get_prefix(self, message: discord.Message) -> Union[List[str], str]:
+        if (timing := current_timing.get()) is not None:
+            start = time.perf_counter()
+            try:
+                return await self._get_prefix(message)
+            finally:
+                timing.prefix += time.perf_counter() - start
+        return await self._get_prefix(message)
+
+    async def _get_prefix(self, message: discord.Message) -> Union[List[str], str]:
         if not message.guild:
-            return commands.when_mentioned_or(
-                *self._get_case_insensitive_prefixes(self._default_prefix)
-            )(self, message)
-
-        prefix = await self.cache.prefix.get_or_fetch(message.guild)
+            matcher = compile_prefix(self._default_prefix)
+            return commands.when_mentioned_or(matcher.resolve(message.content))(self, message)
 
-        if prefix: # Prefix is either found in cache or in database
-            return commands.when_mentioned_or(*self._get_case_insensitive_prefixes(prefix))(self, message)
-
-        # Prefix is not in cache or database. Possible reasons: 
-            # Bot joined the guild when offline
-            # Error in putting prefix in database when joined the guild
-        # Put the default prefix in database, update prefix cache, and return default prefix
-        await self.cache.prefix.insert(self._default_prefix, message.guild)
-        log.debug('Prefix for Guild ID: %s not found in database', message.guild.id)
-        return commands.when_mentioned_or(*self._get_case_insensitive_prefixes(self._default_prefix))(self, message)
+        # Inserts the default prefix if the guild has none yet (e.g. bot joined the guild when offline)
+        matcher = await self.cache.prefix.get_or_insert_matcher(message.guild, self._default_prefix)
+        return commands.when_mentioned_or(matcher.resolve(message.content))(self, message)
 
 
     def initialise_before_run(self) -> None:
@@ -136,34 +185,112 @@ class ApertureBot(commands.Bot):
 
     async def initialise_after_run(self) -> None:
         log.debug('Initialising `after run` setup')
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except Exception as e:
+                log.error('Failed to serve the metrics on port %s, continuing without them', self.metrics_server.port, exc_info=e)
+                self.metrics_server = None
+        if self.watchdog is not None:
+            self.watchdog.start()
+        tracer.start()
+
+        # Load the on-disk cache snapshot (if any) while we connect to the gateway
+        cache_from_snapshot = await self.cache.load_snapshot()
+
         await self.wait_until_ready()
 
         self.http_session = aiohttp.ClientSession()
         log.debug('Created aiohttp session and attached to bot')
 
         self.webhook_client = ApertureManagementWebhookClient(self.http_session)
+        self.webhook_client.start()
         log.debug('Initialized Management Webhook Client')
 
         await self.dump_owner_info()
 
-        # (Try to) Migrate the Database at startup
-        with open('./aperture.sql', 'r', encoding='utf-8') as sql_file:
-            data = sql_file.readlines()
-            query = ''.join(line for line in data)
-            await self.database.execute(query)
-            log.debug('Database Migration completed')
+        # Migrate the Database at startup, this only applies the migrations which are not applied yet
+        await ApertureMigrator(self.database).migrate()
+        log.debug('Database Migration completed')
+
+        # Keep the cache in sync with changes made by other processes
+        self.database.invalidation_bus.subscribe(self.cache.apply_invalidations)
+        self.database.invalidation_bus.start()
 
-        await self.cache.fill_cache()
+        if cache_from_snapshot:
+            # The snapshot is good enough to serve commands, reconcile with the database in background
+            self.loop.create_task(self.reconcile_cache())
+        else:
+            await self.reconcile_cache()
         log.debug('Fetched and prepared bot\'s cache')
 
         await self.cache.start_cache_tasks()
         log.debug('Started cache tasks')
 
+        self.database.stats_task.start()
+
         # Set ready = True after last initialisation step (this method) of the bot.
         self.ready = True
         print('Setup completed! Bot is ready to be operated')
         log.info('Setup completed! Bot is ready to be operated')
 
+    async def reconcile_cache(self) -> None:
+        await self.cache.reconcile()
+
+        # Guilds joined or left while the bot was offline
+        await self.cache.prefix.reconcile_guilds(
+            [guild.id for guild in self.guilds], self._default_prefix, owns=self.owns_guild
+        )
+
+    def owns_guild(self, guild_id: int) -> bool:
+        """Whether the guild is handled by one of the shards of this process."""
+
+        if self.shard_ids is None or self.shard_count is None:
+            return True
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
+
+    def _collect_metrics(self) -> Iterator[Metric]:
+        gateway = Gauge('aperture_gateway_latency_seconds', 'Heartbeat latency of each shard', ('shard', ))
+        for shard_id, latency in self.latencies:
+            if latency == latency: # NaN before the first heartbeat
+                gateway.set(latency, shard_id)
+        yield gateway
+
+        if self.watchdog is not None:
+            yield HistogramMetric.from_histogram(
+                'aperture_event_loop_lag_seconds', 'How late the event loop runs a task', self.watchdog.lag
+            )
+            stalls = Counter('aperture_event_loop_stalls_total', 'Times the event loop was blocked above the threshold')
+            stalls.inc(amount=self.watchdog.stalls)
+            yield stalls
+            samples = Counter('aperture_event_loop_stall_samples_total', 'Stack samples taken while the loop was blocked')
+            samples.inc(amount=self.watchdog.samples)
+            yield samples
+
+        cache = getattr(self, 'cache', None)
+        if cache is not None:
+            depth = Gauge('aperture_command_usage_pending', 'Command invocations waiting to be written in the database')
+            depth.set(len(cache.command_usage))
+            yield depth
+
+        database = getattr(self, 'database', None)
+        if database is not None and database.pool is not None:
+            stats = database.get_pool_stats()
+            connections = Gauge('aperture_db_pool_connections', 'Connections of the database pool', ('state', ))
+            connections.set(stats['in_use'], 'in_use')
+            connections.set(stats['idle'], 'idle')
+            yield connections
+
+            timeouts = Counter('aperture_db_timeouts_total', 'Timed out pool acquisitions and queries', ('kind', ))
+            timeouts.inc('acquire', amount=stats['acquire_timeouts'])
+            timeouts.inc('query', amount=stats['query_timeouts'])
+            yield timeouts
+
+            yield HistogramMetric.from_histogram(
+                'aperture_db_pool_acquire_wait_seconds', 'Time waited to acquire a connection',
+                database.pool_stats.acquire_wait
+            )
+
     async def dump_owner_info(self) -> None:
         app_info: discord.AppInfo = await self.application_info()
         if not app_info.team:
@@ -195,12 +322,26 @@ class ApertureBot(commands.Bot):
             await self.cache.stop_cache_tasks()
             log.debug('Stopped cache tasks')
 
+            await self.cache.dump_snapshot()
+
+            self.database.stats_task.stop()
+
+            await self.webhook_client.close()
+            log.debug('Sent the pending reports')
+
             await self.http_session.close()
             log.debug('Closed aiohttp session')
 
             await self.database.close_pool()
             log.debug('Closed database connection')
 
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+
+        await tracer.close()
+
 
     # Listeners (Modified in aperture.core.listeners)
     async def on_message(self, message: discord.Message) -> None:
@@ -217,6 +358,7 @@ class ApertureBot(commands.Bot):
 
     # Listeners (Unmodified)
     async def on_connect(self) -> None:
+        self._mention_prefixes = (f'<@{self.user.id}>', f'<@!{self.user.id}>')
         print(f'Connected. Latency: {round(self.latency*1000)} ms')
         log.info('Connected. Latency: %s ms', round(self.latency*1000))
 
@@ -247,14 +389,77 @@ class ApertureBot(commands.Bot):
         return await super().wait_for(event, check=check, timeout=timeout)
 
     async def process_commands(self, message: discord.Message) -> None:
-        ctx = await self.get_context(message, cls=ApertureContext)
+        # Most of the messages aren't commands, drop them before building a context
+        if self._is_blacklisted(message) or not self._could_be_command(message):
+            return
+
+        if not tracer.enabled:
+            return await self._process_commands(message)
+
+        with tracer.trace('message', message_id=message.id, channel_id=message.channel.id):
+            await self._process_commands(message)
+
+    async def _process_commands(self, message: discord.Message) -> None:
+        # Bound once, the timings may be turned off while the command runs (e.g. by ``timings off`` itself)
+        timings = self.pipeline_timings
+        timing = CommandTiming() if timings is not None else None
+
+        with tracer.span('get_context'):
+            token = current_timing.set(timing)
+            try:
+                ctx = await self.get_context(message, cls=ApertureContext)
+            finally:
+                current_timing.reset(token)
+        if timing is not None:
+            timing.context = timing.lap() - timing.prefix
 
         if ctx.command is None:
+            tracer.drop()
             return
 
+        ctx.timings = timing
+        with tracer.span('pre_checks'):
+            passed = await self._pre_checks(ctx)
+        if timing is not None:
+            timing.checks = timing.lap()
+
+        if passed:
+            await self._invoke_measured(ctx)
+        if timing is not None:
+            timings.record(ctx.command.qualified_name, timing)
+
+    def _is_blacklisted(self, message: discord.Message) -> bool:
+        if message.guild is not None and message.guild.id in self.cache.blacklist.guilds:
+            self._blacklist_rejections.inc('guild')
+            return True
+        if message.author.id in self.cache.blacklist.users:
+            self._blacklist_rejections.inc('user')
+            return True
+        return False
+
+    def _could_be_command(self, message: discord.Message) -> bool:
+        """Cheap pre-filter on the message content, using the cached prefix of the guild.
+        May return ``True`` for messages which aren't commands, never the other way around."""
+
+        content = message.content
+        if not content:
+            return False
+        if content.startswith(self._mention_prefixes):
+            return True
+
+        if message.guild is None:
+            matcher = compile_prefix(self._default_prefix)
+        else:
+            matcher = self.cache.prefix.matchers.get(message.guild.id)
+            if matcher is None:
+                # Not cached yet, the full path fetches (or inserts) the prefix
+                return True
+        return matcher.matches(content)
+
+    async def _pre_checks(self, ctx: ApertureContext) -> bool:
         if not self.ready:
-            await message.reply('Booting Up... Please wait for a few seconds', mention_author=False)
-            return
+            await ctx.message.reply('Booting Up... Please wait for a few seconds', mention_author=False)
+            return False
 
         # Check for permissions of bot in the guild
         if isinstance(ctx.me, discord.Member):
@@ -274,12 +479,66 @@ class ApertureBot(commands.Bot):
                         "Use external emojis, View channel`. Please make sure I atleast have these permissions!"
                     )
                     log.debug('Missing minimum permissions for guild id: %s', ctx.guild.id)
-                    return
-
-        # Check if the guild or user is blacklisted
-        if ctx.guild is not None and ctx.guild.id in self.cache.blacklist.guilds:
+                    return False
+
+        return True
+
+    async def _invoke_measured(self, ctx: ApertureContext) -> None:
+        name = ctx.command.qualified_name
+        self._commands_invoked.inc(name)
+        start = time.perf_counter()
+        try:
+            with tracer.span('invoke', command=name):
+                await self.invoke(ctx)
+        finally:
+            self._command_duration.observe(time.perf_counter() - start, name)
+
+    # Command pipeline timings
+    def enable_timings(self) -> None:
+        """Starts recording, wrapping the bot's invoke hooks (if any) so they still run."""
+
+        if self.pipeline_timings is None:
+            self.pipeline_timings = PipelineTimings()
+        if self._timing_hooks is not None:
             return
-        if ctx.author.id in self.cache.blacklist.users:
+
+        # The time spent in the other hooks counts towards the prepare stage, not the callback
+        before = self._chain_hooks(self._before_invoke, self._timings_before_invoke)
+        after = self._chain_hooks(self._timings_after_invoke, self._after_invoke)
+        self._timing_hooks = (self._before_invoke, self._after_invoke, before, after)
+        self._before_invoke, self._after_invoke = before, after
+
+    def disable_timings(self) -> None:
+        """Stops recording. Commands already running finish recording into the previous timings."""
+
+        self.pipeline_timings = None
+        if self._timing_hooks is None:
             return
 
-        await self.invoke(ctx)
+        previous_before, previous_after, before, after = self._timing_hooks
+        self._timing_hooks = None
+        # Hooks registered after enabling the timings replaced ours already, they are kept
+        if self._before_invoke is before:
+            self._before_invoke = previous_before
+        if self._after_invoke is after:
+            self._after_invoke = previous_after
+
+    @staticmethod
+    def _chain_hooks(first: Optional[InvokeHook], second: Optional[InvokeHook]) -> Optional[InvokeHook]:
+        if first is None or second is None:
+            return first or second
+
+        async def hook(ctx: ApertureContext) -> None:
+            await first(ctx)
+            await second(ctx)
+        return hook
+
+    @staticmethod
+    async def _timings_before_invoke(ctx: ApertureContext) -> None:
+        if ctx.timings is not None:
+            ctx.timings.prepare = ctx.timings.lap()
+
+    @staticmethod
+    async def _timings_after_invoke(ctx: ApertureContext) -> None:
+        if ctx.timings is not None:
+            ctx.timings.callback = ctx.timings.lap()
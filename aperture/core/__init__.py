@@ -4,3 +4,5 @@ from .database import ApertureDatabase
 from .embed import ApertureEmbed
 from .emoji import ApertureEmoji
 from .logging import ApertureLogger
+from .metrics import ApertureMetrics
+from .migrations import ApertureMigrator
@@ -17,17 +17,23 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
 
+import os
+import asyncio
+import asyncpg
 import logging
 
 from .prefix import Prefix
 from .blacklist import Blacklist
 from .premium import Premium
 from .command_usage import CommandUsage
+from .snapshot import CacheSnapshot, dump_snapshot, load_snapshot
+from .snowflake_set import SnowflakeSet
 
 if TYPE_CHECKING:
     from aperture import ApertureBot
+    from aperture.core.invalidation import Invalidation
 
 
 log = logging.getLogger('aperture.core.cache')
@@ -40,14 +46,119 @@ class ApertureCache:
         self.prefix = Prefix(bot)
         self.blacklist = Blacklist(bot)
         self.premium = Premium(bot)
-        self.command_usage = CommandUsage(bot)
+        self.command_usage = CommandUsage(
+            bot, capture_raw=os.getenv('COMMAND_STATS_RAW', 'true').lower() == 'true'
+        )
+
+        # Optional on-disk snapshot of the cache, used to serve commands right after a restart
+        self.snapshot_path: Optional[str] = os.getenv('CACHE_SNAPSHOT_PATH') or None
 
     async def fill_cache(self) -> None:
-        await self.prefix.fill()
-        await self.blacklist.fill()
-        await self.premium.fill()
+        prefixes: List[asyncpg.Record]
+        core: List[asyncpg.Record]
+        prefixes, core = await asyncio.gather(
+            self.bot.database.statement('prefix.all').fetch(),
+            self.bot.database.statement('core.flagged').fetch(),
+        )
+
+        self.prefix.replace({row['guild_id']: row['prefix'] for row in prefixes})
+        self.blacklist.guilds.replace(row['id'] for row in core if row['is_guild'] and row['blacklisted'])
+        self.blacklist.users.replace(row['id'] for row in core if not row['is_guild'] and row['blacklisted'])
+        self.premium.guilds.replace(row['id'] for row in core if row['is_guild'] and row['premium'])
+        self.premium.users.replace(row['id'] for row in core if not row['is_guild'] and row['premium'])
         log.info('Filled bot cache from the database')
 
+    def _snapshot(self) -> CacheSnapshot:
+        return CacheSnapshot(
+            blacklisted_guilds=self.blacklist.guilds.data,
+            blacklisted_users=self.blacklist.users.data,
+            premium_guilds=self.premium.guilds.data,
+            premium_users=self.premium.users.data,
+            prefixes=self.prefix.data,
+        )
+
+    async def load_snapshot(self) -> bool:
+        """Fills the cache from the on-disk snapshot. Returns whether a snapshot was loaded."""
+
+        if self.snapshot_path is None:
+            return False
+
+        loop = asyncio.get_running_loop()
+        try:
+            snapshot = await loop.run_in_executor(None, load_snapshot, self.snapshot_path)
+        except Exception as e:
+            log.warning('Failed to load cache snapshot from %s', self.snapshot_path, exc_info=e)
+            return False
+
+        if snapshot is None:
+            return False
+
+        self.prefix.replace(snapshot.prefixes)
+        self.blacklist.guilds.replace(snapshot.blacklisted_guilds)
+        self.blacklist.users.replace(snapshot.blacklisted_users)
+        self.premium.guilds.replace(snapshot.premium_guilds)
+        self.premium.users.replace(snapshot.premium_users)
+        log.info('Filled bot cache from the snapshot at %s', self.snapshot_path)
+        return True
+
+    async def dump_snapshot(self) -> None:
+        if self.snapshot_path is None:
+            return
+
+        # Copy on the event loop so the executor thread never sees the cache changing under it
+        snapshot = CacheSnapshot(*(type(data)(data) for data in self._snapshot()))
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, dump_snapshot, self.snapshot_path, snapshot)
+        except Exception as e:
+            log.warning('Failed to dump cache snapshot to %s', self.snapshot_path, exc_info=e)
+            return
+        log.debug('Dumped cache snapshot to %s', self.snapshot_path)
+
+    async def reconcile(self) -> None:
+        """Refills the cache from the database and refreshes the snapshot."""
+
+        await self.fill_cache()
+        await self.dump_snapshot()
+
+    async def apply_invalidations(self, batch: List[Invalidation], resync: bool) -> None:
+        """Applies the changes made by other processes, notified through the database's invalidation bus."""
+
+        if resync:
+            await self.reconcile()
+            log.info('Resynced cache after losing the invalidation listener')
+            return
+
+        for invalidation in batch:
+            row = invalidation.row
+            deleted = invalidation.op == 'DELETE'
+
+            if invalidation.table == 'prefixes':
+                if deleted:
+                    self.prefix.pop(row['guild_id'], None)
+                else:
+                    self.prefix[row['guild_id']] = row['prefix']
+            elif invalidation.table == 'guilds_core':
+                self._apply_core_invalidation(row['guild_id'], row, deleted, self.blacklist.guilds, self.premium.guilds)
+            elif invalidation.table == 'users_core':
+                self._apply_core_invalidation(row['user_id'], row, deleted, self.blacklist.users, self.premium.users)
+
+        log.debug('Applied %s cache invalidations', len(batch))
+
+    @staticmethod
+    def _apply_core_invalidation(
+        id: int,
+        row: Dict[str, Any],
+        deleted: bool,
+        blacklist: SnowflakeSet,
+        premium: SnowflakeSet
+    ) -> None:
+        for ids, column in ((blacklist, 'blacklisted'), (premium, 'premium')):
+            if not deleted and row.get(column):
+                ids.data.add(id)
+            else:
+                ids.data.discard(id)
+
     async def start_cache_tasks(self) -> None:
         """Starts all the task"""
         # We don't start our tasks here since we also need to close them on shutdown,
@@ -58,4 +169,5 @@ class ApertureCache:
     async def stop_cache_tasks(self) -> None:
         # Stopping allows tasks to complete their current running iteration, so it may take time for the tasks to stop.
         self.command_usage.dump_task.stop()
+        await self.prefix.writes.flush()
         log.debug('Cache routine tasks stopepd')
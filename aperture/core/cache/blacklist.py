@@ -17,15 +17,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING
 
-import asyncpg
-from collections import UserList
-import contextlib
 import logging
 
 from discord import abc
 
+from .snowflake_set import SnowflakeSet, SnowflakeSetUnion
+
 if TYPE_CHECKING:
     from aperture import ApertureBot
 
@@ -33,50 +32,42 @@ if TYPE_CHECKING:
 log = logging.getLogger('aperture.core.cache')
 
 
-class GuildBlacklist(UserList):
+class GuildBlacklist(SnowflakeSet):
     def __init__(self, bot: ApertureBot) -> None:
         super().__init__()
         self.bot = bot
 
     async def insert(self, guild: abc.Snowflake) -> None:
-        query = 'INSERT INTO guilds_core (guild_id, blacklisted, premium) VALUES ($1, true, false) '\
-            'ON CONFLICT (guild_id) DO UPDATE SET blacklisted=true;'
-        await self.bot.database.execute(query, guild.id)
+        await self.bot.database.statement('blacklist.insert_guild').execute(guild.id)
 
-        self.data.append(guild.id)
+        self.data.add(guild.id)
 
         log.debug('Blacklisted guild with ID: %s', guild.id)
 
     async def remove(self, guild: abc.Snowflake) -> None:
-        query ='UPDATE guilds_core SET blacklisted=false WHERE guild_id=$1;'
-        await self.bot.database.execute(query, guild.id)
+        await self.bot.database.statement('blacklist.remove_guild').execute(guild.id)
         
-        with contextlib.suppress(ValueError):
-            self.data.remove(guild.id)
+        self.data.discard(guild.id)
 
         log.debug('Removed blacklist from guild with ID: %s', guild.id)
 
 
-class UserBlacklist(UserList):
+class UserBlacklist(SnowflakeSet):
     def __init__(self, bot: ApertureBot) -> None:
         super().__init__()
         self.bot = bot
 
     async def insert(self, user: abc.Snowflake) -> None:
-        query = 'INSERT INTO users_core (user_id, blacklisted, premium) VALUES ($1, true, false) '\
-            'ON CONFLICT (user_id) DO UPDATE SET blacklisted=true;'
-        await self.bot.database.execute(query, user.id)
+        await self.bot.database.statement('blacklist.insert_user').execute(user.id)
 
-        self.data.append(user.id)
+        self.data.add(user.id)
 
         log.debug('Blacklisted user with ID: %s', user.id)
 
     async def remove(self, user: abc.Snowflake) -> None:
-        query = 'UPDATE users_core SET blacklisted=false WHERE user_id=$1;'
-        await self.bot.database.execute(query, user.id)
+        await self.bot.database.statement('blacklist.remove_user').execute(user.id)
         
-        with contextlib.suppress(ValueError):
-            self.data.remove(user.id)
+        self.data.discard(user.id)
 
         log.debug('Removed blacklist from user with ID: %s', user.id)
 
@@ -84,18 +75,10 @@ class UserBlacklist(UserList):
 class Blacklist:
     def __init__(self, bot: ApertureBot) -> None:
         self.bot = bot
-        self.guilds: List[int] = GuildBlacklist(bot)
-        self.users: List[int] = UserBlacklist(bot)
+        self.guilds = GuildBlacklist(bot)
+        self.users = UserBlacklist(bot)
+        self._all = SnowflakeSetUnion(self.guilds, self.users)
 
     @property
-    def all(self) -> List[int]:
-        return self.guilds + self.users
-
-    async def fill(self) -> None:
-        data: List[asyncpg.Record] = await self.bot.database.fetch('SELECT guild_id FROM guilds_core WHERE blacklisted=true;')
-        for row in data:
-            self.guilds.append(row['guild_id'])
-        data: List[asyncpg.Record] = await self.bot.database.fetch('SELECT user_id FROM users_core WHERE blacklisted=true;')
-        for row in data:
-            self.users.append(row['user_id'])
-        log.debug('Filled blacklist cache')
+    def all(self) -> SnowflakeSetUnion:
+        return self._all
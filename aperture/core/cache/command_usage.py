@@ -17,10 +17,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import List, Optional, Tuple, TYPE_CHECKING
+from typing import Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
 
+import time
 import asyncio
-from collections import UserList
+import asyncpg
+import datetime
+from array import array
+from collections import Counter
 import logging
 
 from discord import abc
@@ -28,21 +32,90 @@ from discord.ext import commands, tasks
 
 if TYPE_CHECKING:
     from aperture import ApertureBot
+    from aperture.core.database import ApertureConnection
 
 
 log = logging.getLogger('aperture.core.cache')
 
 
-class CommandUsage(UserList):
-    """``Note``: This list contains only the statistics of last 30 seconds since we run a task
-    which put the statistics into the Database after every 30 seconds and clears the cache
-    for memory optimisation and persistency.
+class CommandUsageBuffer:
+    """Column oriented buffer of command invocations.
+
+    Every column is a flat array, so an invocation costs a few machine words instead of a dict.
+    ``guild_id`` is stored as ``0`` for commands invoked outside of a guild.
+    """
+
+    __slots__ = ('names', 'types', 'user_ids', 'guild_ids')
+
+    def __init__(self) -> None:
+        self.names: List[str] = []
+        self.types: array = array('B')
+        self.user_ids: array = array('Q')
+        self.guild_ids: array = array('Q')
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def append(self, name: str, command_type: int, user_id: int, guild_id: Optional[int]) -> None:
+        self.names.append(name)
+        self.types.append(command_type)
+        self.user_ids.append(user_id)
+        self.guild_ids.append(guild_id or 0)
+
+    def extend(self, other: CommandUsageBuffer) -> None:
+        self.names.extend(other.names)
+        self.types.extend(other.types)
+        self.user_ids.extend(other.user_ids)
+        self.guild_ids.extend(other.guild_ids)
+
+    def drop_oldest(self, count: int) -> None:
+        del self.names[:count], self.types[:count], self.user_ids[:count], self.guild_ids[:count]
+
+    def records(self) -> Iterator[Tuple[str, int, int, Optional[int]]]:
+        for name, command_type, user_id, guild_id in zip(self.names, self.types, self.user_ids, self.guild_ids):
+            yield name, command_type, user_id, guild_id or None
+
+
+# (name, type, guild_id or 0, minute since epoch)
+RollupKey = Tuple[str, int, int, int]
+
+# Rollup upsert statement -> bucket size in seconds
+ROLLUP_STATEMENTS: Dict[str, int] = {
+    'command_stats.upsert_minutely': 60,
+    'command_stats.upsert_hourly': 60 * 60,
+}
+
+
+class CommandUsage:
+    """``Note``: This buffer contains only the statistics since the last flush, since we run a task
+    which put the statistics into the Database after every 30 seconds (or as soon as ``max_size``
+    invocations are buffered) and swaps in an empty buffer for memory optimisation and persistency.
+
+    Alongside the raw invocations, usage is pre-aggregated per (command, type, guild, minute) and
+    upserted into the ``command_stats_minutely`` and ``command_stats_hourly`` rollup tables on every
+    flush. Capturing raw invocations into ``command_stats`` can be turned off with ``capture_raw``.
     """
 
-    def __init__(self, bot: ApertureBot) -> None:
-        super().__init__()
+    def __init__(self, bot: ApertureBot, *, max_size: int = 5000, capture_raw: bool = True) -> None:
         self.bot = bot
         self.lock = asyncio.Lock()
+        self.max_size: int = max_size
+        self.capture_raw: bool = capture_raw
+        self.buffer: CommandUsageBuffer = CommandUsageBuffer()
+        self.rollup: Counter[RollupKey] = Counter()
+        self._pending: int = 0
+        # Invocations put back after a failed flush, these don't count towards ``max_size``
+        # so an unavailable database is retried by ``dump_task`` instead of on every command
+        self._retrying: int = 0
+        # Raw invocations kept while the database is unavailable
+        self.max_raw_backlog: int = max_size * 10
+        self.flush_time = bot.metrics.histogram(
+            'aperture_command_usage_flush_seconds', 'Time taken to write the buffered command invocations'
+        )
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return self._pending
 
     async def add(
         self,
@@ -51,36 +124,113 @@ class CommandUsage(UserList):
         user: abc.Snowflake,
         guild: Optional[abc.Snowflake]
     ):
-        self.data.append(
-            {
-                'name': command.name,
-                'type': command_type,
-                'user_id': user.id,
-                'guild_id': guild.id if guild is not None else None
-            }
-        )
+        guild_id = guild.id if guild is not None else None
+        if self.capture_raw:
+            self.buffer.append(command.name, command_type, user.id, guild_id)
+        self.rollup[(command.name, command_type, guild_id or 0, int(time.time()) // 60)] += 1
+        self._pending += 1
+
+        if self._pending - self._retrying >= self.max_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self) -> None:
+        async with self.lock:
+            await self._dump_in_database()
 
     async def _dump_in_database(self):
-        if self.data:
-            # Make a copy of the dict and instantly clear the original to prevent 
-            # inconsistency of stats because of time taken by database
-            stats = self.data
-            self.data.clear()
-
-            values: List[Tuple[str, int, int, Optional[int]]] = []
-            for usage in stats:
-                values.append((usage['name'], usage['type'], usage['user_id'], usage['guild_id']))
-
-            await self.bot.database.executemany(
-                'INSERT INTO command_stats (name, type, user_id, guild_id) VALUES ($1, $2, $3, $4);', values
+        if not self._pending:
+            return
+
+        # Swap in a fresh buffer and counters before awaiting the database so invocations
+        # recorded meanwhile go into the next batch
+        buffer, self.buffer = self.buffer, CommandUsageBuffer()
+        rollup, self.rollup = self.rollup, Counter()
+        pending, self._pending, self._retrying = self._pending, 0, 0
+
+        start = time.perf_counter()
+        try:
+            # The rollups and the raw invocations are written all or nothing, so a failed flush
+            # can be retried as a whole without counting any invocation twice
+            async with self.bot.database.transaction() as connection:
+                await self._upsert_rollups(rollup, connection)
+                if buffer:
+                    await self.bot.database.copy_records_to_table(
+                        'command_stats',
+                        records=buffer.records(),
+                        columns=('name', 'type', 'user_id', 'guild_id'),
+                        connection=connection
+                    )
+        except Exception as e:
+            log.error('Failed to dump %s command stats into database, retrying on the next flush', pending, exc_info=e)
+            self._restore(buffer, rollup, pending)
+            return
+
+        self.flush_time.observe(time.perf_counter() - start)
+        log.debug('Dumped %s command stats (%s rollup rows) into database', pending, len(rollup))
+
+    def _restore(self, buffer: CommandUsageBuffer, rollup: Counter[RollupKey], pending: int) -> None:
+        """Puts a batch which failed to be written back in front of the live one."""
+
+        buffer.extend(self.buffer)
+        # Rollups are small (one row per command, guild and minute), only the raw invocations are capped
+        if (excess := len(buffer) - self.max_raw_backlog) > 0:
+            buffer.drop_oldest(excess)
+            log.warning('Dropped %s raw command invocations which could not be written into database', excess)
+        self.buffer = buffer
+
+        rollup.update(self.rollup)
+        self.rollup = rollup
+        self._pending += pending
+        self._retrying = pending
+
+    async def _upsert_rollups(self, rollup: Counter[RollupKey], connection: ApertureConnection) -> None:
+        for statement, seconds in ROLLUP_STATEMENTS.items():
+            # Minutely counters are re-aggregated for the coarser buckets
+            counts: Counter[Tuple[str, int, int, int]] = Counter()
+            for (name, command_type, guild_id, minute), uses in rollup.items():
+                counts[(name, command_type, guild_id, minute * 60 // seconds * seconds)] += uses
+
+            names, types, guild_ids, buckets, uses = [], [], [], [], []
+            for (name, command_type, guild_id, bucket), count in counts.items():
+                names.append(name)
+                types.append(command_type)
+                guild_ids.append(guild_id)
+                buckets.append(datetime.datetime.fromtimestamp(bucket, tz=datetime.timezone.utc))
+                uses.append(count)
+
+            await self.bot.database.statement(statement).execute(
+                buckets, names, types, guild_ids, uses, connection=connection
             )
-            log.debug('Dumped command stats into database and cleared it\'s cache')
+
+    async def top_commands(
+        self,
+        since: datetime.datetime,
+        *,
+        guild: Optional[abc.Snowflake] = None,
+        limit: int = 10
+    ) -> List[Tuple[str, int]]:
+        """Returns the most used commands since ``since`` as ``(name, uses)`` pairs.
+        This reads the hourly rollups (so ``since`` is rounded down to the hour), never the raw invocations.
+        Usage which is not flushed yet is included as well."""
+
+        since = since.astimezone(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+        data: List[asyncpg.Record] = await self.bot.database.statement('command_stats.top').fetch(
+            since, guild.id if guild is not None else None
+        )
+
+        counts: Counter[str] = Counter({row['name']: row['uses'] for row in data})
+        since_minute = int(since.timestamp()) // 60
+        for (name, _, guild_id, minute), uses in self.rollup.items():
+            if minute >= since_minute and (guild is None or guild_id == guild.id):
+                counts[name] += uses
+
+        return counts.most_common(limit)
 
     @tasks.loop(seconds=30)
     async def dump_task(self):
-        async with self.lock:
-            await self._dump_in_database()
+        await self.flush()
 
     @dump_task.after_loop
     async def dump_task_safe_fallback(self):
-        await self._dump_in_database()
+        # Waits for a threshold triggered flush (if any) before dumping the rest
+        await self.flush()
@@ -17,14 +17,19 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import List, Optional, TYPE_CHECKING
+from typing import Callable, Collection, Dict, List, Optional, Set, TYPE_CHECKING
 
+import re
+import asyncio
 import asyncpg
 from collections import UserDict
+import functools
 import logging
 
 from discord import abc
 
+from .single_flight import SingleFlight
+
 if TYPE_CHECKING:
     from aperture import ApertureBot
 
@@ -32,44 +37,230 @@ if TYPE_CHECKING:
 log = logging.getLogger('aperture.core.cache')
 
 
+class PrefixMatcher:
+    """A prefix compiled once into a case insensitive matcher.
+
+    Resolving a message's prefix costs a single anchored regex match over ``len(prefix)``
+    characters instead of scanning every upper/lower case permutation of the prefix.
+    """
+
+    __slots__ = ('prefix', '_match')
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix: str = prefix
+        self._match = re.compile(re.escape(prefix), re.IGNORECASE).match
+
+    def resolve(self, content: str) -> str:
+        """Returns the prefix exactly as it is written in ``content``,
+        or the original prefix if ``content`` does not start with it."""
+
+        match = self._match(content)
+        if match is None:
+            return self.prefix
+        return match.group()
+
+    def matches(self, content: str) -> bool:
+        """Whether ``content`` starts with the prefix."""
+
+        return self._match(content) is not None
+
+    def __repr__(self) -> str:
+        return f'<PrefixMatcher prefix={self.prefix!r}>'
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_prefix(prefix: str) -> PrefixMatcher:
+    # Most of the guilds share the same (default) prefix, so they share the same matcher too
+    return PrefixMatcher(prefix)
+
+
+class PrefixWriteBatcher:
+    """Coalesces prefix inserts and deletes (e.g. from a storm of guild join/leave events)
+    into one bulk ``INSERT`` and one bulk ``DELETE`` every ``delay`` seconds.
+
+    Only the latest write of a guild is kept, so a guild joined and left within
+    the same window costs nothing. Writes of a failed flush are queued again (unless the
+    guild was written meanwhile) and retried with a backoff of up to 60 seconds.
+    """
+
+    def __init__(self, bot: ApertureBot, *, delay: float = 1.0, max_size: int = 1000) -> None:
+        self.bot = bot
+        self.delay: float = delay
+        self.max_size: int = max_size
+
+        self.lock = asyncio.Lock()
+        self._inserts: Dict[int, str] = {}
+        self._deletes: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._retry_delay: float = delay
+
+    def __len__(self) -> int:
+        return len(self._inserts) + len(self._deletes)
+
+    def insert(self, guild_id: int, prefix: str) -> None:
+        self._deletes.discard(guild_id)
+        self._inserts[guild_id] = prefix
+        self._schedule()
+
+    def remove(self, guild_id: int) -> None:
+        self._inserts.pop(guild_id, None)
+        self._deletes.add(guild_id)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        # While retrying a failed flush, the writes wait for the retry instead of flushing early
+        if len(self) >= self.max_size and self._retry_delay == self.delay:
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self.flush())
+        elif self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later(self.delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self.lock:
+            inserts, self._inserts = self._inserts, {}
+            deletes, self._deletes = self._deletes, set()
+
+            try:
+                if inserts:
+                    await self.bot.database.statement('prefix.insert_many').execute(
+                        list(inserts.keys()), list(inserts.values())
+                    )
+                if deletes:
+                    await self.bot.database.statement('prefix.delete_many').execute(list(deletes))
+            except Exception as e:
+                log.error(
+                    'Failed to write %s prefix inserts and %s deletes, retrying in %ss',
+                    len(inserts), len(deletes), self._retry_delay, exc_info=e
+                )
+                self._requeue(inserts, deletes)
+                return
+
+            self._retry_delay = self.delay
+            if inserts or deletes:
+                log.debug('Wrote %s prefix inserts and %s deletes', len(inserts), len(deletes))
+
+    def _requeue(self, inserts: Dict[int, str], deletes: Set[int]) -> None:
+        # The writes queued since the failed flush are newer, they win over the failed ones
+        for guild_id, prefix in inserts.items():
+            if guild_id not in self._inserts and guild_id not in self._deletes:
+                self._inserts[guild_id] = prefix
+        for guild_id in deletes:
+            if guild_id not in self._inserts:
+                self._deletes.add(guild_id)
+
+        # The failed flush may be the one ``_task`` is running, which is about to finish
+        if self._task is None or self._task.done() or self._task is asyncio.current_task():
+            self._task = asyncio.create_task(self._flush_later(self._retry_delay))
+        self._retry_delay = min(self._retry_delay * 2, 60.0)
+
+
 class Prefix(UserDict):
     def __init__(self, bot: ApertureBot) -> None:
         super().__init__()
         self.bot = bot
+        self.matchers: Dict[int, PrefixMatcher] = {}
+        self.writes: PrefixWriteBatcher = PrefixWriteBatcher(bot)
+
+        # Coalesces concurrent cache misses for the same guild into one database round trip
+        self._lookups: SingleFlight[str] = SingleFlight()
+
+        self.lookups = bot.metrics.counter(
+            'aperture_prefix_cache_lookups_total', 'Guild prefix lookups, by whether they were cached', ('result', )
+        )
+
+    def __setitem__(self, guild_id: int, prefix: str) -> None:
+        self.data[guild_id] = prefix
+        self.matchers[guild_id] = compile_prefix(prefix)
+
+    def __delitem__(self, guild_id: int) -> None:
+        del self.data[guild_id]
+        self.matchers.pop(guild_id, None)
 
-    async def get_or_fetch(self, guild: abc.Snowflake) -> Optional[str]:
-        prefix = self.data.get(guild.id)
-        if prefix:
-            return prefix
+    async def get_or_insert_matcher(self, guild: abc.Snowflake, default: str) -> PrefixMatcher:
+        """Returns the matcher of the guild's prefix, inserting ``default`` as the guild's prefix
+        if it doesn't have one yet. Concurrent calls for the same guild share a single round trip."""
 
-        query = 'SELECT * FROM prefixes WHERE guild_id=$1;'
-        _data: asyncpg.Record = await self.bot.database.fetchrow(query, guild.id)
-        if _data:
-            self.data[guild.id] = _data['prefix']
-            return _data['prefix']
+        matcher = self.matchers.get(guild.id)
+        if matcher is not None:
+            self.lookups.inc('hit')
+            return matcher
 
-        return None
+        self.lookups.inc('miss')
+        # Built from the returned prefix, the cache entry may already be gone again (e.g. the guild was left meanwhile)
+        prefix = await self._lookups.do(guild.id, lambda: self._fetch_or_insert(guild.id, default))
+        return compile_prefix(prefix)
+
+    async def _fetch_or_insert(self, guild_id: int, default: str) -> str:
+        _data: Optional[asyncpg.Record] = await self.bot.database.statement('prefix.get_or_insert').fetchrow(guild_id, default)
+        if _data is None:
+            # Another process inserted the row after our statement took its snapshot
+            _data = await self.bot.database.statement('prefix.get').fetchrow(guild_id)
+
+        self[guild_id] = _data['prefix']
+
+        if _data.get('inserted'):
+            # Possible reasons:
+                # Bot joined the guild when offline
+                # Error in putting prefix in database when joined the guild
+            log.debug('Prefix for Guild ID: %s not found in database, inserted the default prefix', guild_id)
+        return _data['prefix']
 
     async def insert(self, prefix: str, guild: abc.Snowflake) -> None:
-        query = 'INSERT INTO prefixes (prefix, guild_id) VALUES ($1, $2);'
-        await self.bot.database.execute(query, prefix, guild.id)
+        await self.bot.database.statement('prefix.upsert').execute(prefix, guild.id)
 
-        self.data[guild.id] = prefix
+        self[guild.id] = prefix
 
         log.debug('Prefix %s added for Guild ID: %s', prefix, guild.id)
 
     async def remove(self, guild: abc.Snowflake) -> None:
-        query = 'DELETE FROM prefixes WHERE guild_id=$1;'
-        await self.bot.database.execute(query, guild.id)
+        await self.bot.database.statement('prefix.delete').execute(guild.id)
 
         # Safe Mode: If the prefix is not in cache (like in the case mentioned in bot.get_prefix),
         # we don't need to raise any Exception
-        self.data.pop(guild.id, None)
+        self.pop(guild.id, None)
 
         log.debug('Prefix removed for Guild ID: %s', guild.id)
 
-    async def fill(self) -> None:
-        _data: List[asyncpg.Record] = await self.bot.database.fetch('SELECT guild_id, prefix FROM prefixes;')
-        for row in _data:
-            self.data[row['guild_id']] = row['prefix']
-        log.debug('Filled prefix cache')
+    def queue_insert(self, prefix: str, guild: abc.Snowflake) -> None:
+        """Same as :meth:`insert` (but keeps an existing prefix), except that the database write is batched."""
+
+        if guild.id not in self.data:
+            self[guild.id] = prefix
+        self.writes.insert(guild.id, prefix)
+
+    def queue_remove(self, guild: abc.Snowflake) -> None:
+        """Same as :meth:`remove`, except that the database write is batched."""
+
+        self.pop(guild.id, None)
+        self.writes.remove(guild.id)
+
+    async def reconcile_guilds(self, guild_ids: Collection[int], default: str, *, owns: Callable[[int], bool]) -> None:
+        """Inserts the default prefix for the guilds joined while the bot was offline and deletes the prefixes
+        of the guilds left meanwhile, in bulk. ``owns`` tells whether a guild belongs to this process's shards,
+        so the prefixes of guilds handled by other processes are left untouched."""
+
+        current: Set[int] = set(guild_ids)
+        known: Set[int] = {guild_id for guild_id in self.data if owns(guild_id)}
+        missing = current - known
+        departed = known - current
+
+        if missing:
+            await self.bot.database.statement('prefix.insert_many').execute(list(missing), [default] * len(missing))
+            for guild_id in missing:
+                self[guild_id] = default
+        if departed:
+            await self.bot.database.statement('prefix.delete_many').execute(list(departed))
+            for guild_id in departed:
+                self.pop(guild_id, None)
+
+        log.info('Reconciled prefixes: inserted %s and deleted %s', len(missing), len(departed))
+
+    def replace(self, prefixes: Dict[int, str]) -> None:
+        # Builds the new mappings first, so readers never see a partially filled cache
+        matchers = {guild_id: compile_prefix(prefix) for guild_id, prefix in prefixes.items()}
+        self.data, self.matchers = prefixes, matchers
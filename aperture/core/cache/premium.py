@@ -17,16 +17,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING
 
-import asyncpg
-from collections import UserList
-import contextlib
 import logging
 
 from discord import abc
 from aperture.core import error
 
+from .snowflake_set import SnowflakeSet, SnowflakeSetUnion
+
 if TYPE_CHECKING:
     from aperture import ApertureBot
 
@@ -34,31 +33,27 @@ if TYPE_CHECKING:
 log = logging.getLogger('aperture.core.cache')
 
 
-class GuildPremium(UserList):
+class GuildPremium(SnowflakeSet):
     def __init__(self, bot: ApertureBot) -> None:
         super().__init__()
         self.bot = bot
 
     async def insert(self, guild: abc.Snowflake) -> None:
-        query = 'INSERT INTO guilds_core (guild_id, blacklisted, premium) VALUES ($1, false, true) '\
-            'ON CONFLICT (guild_id) DO UPDATE SET premium=true;'
-        await self.bot.database.execute(query, guild.id)
+        await self.bot.database.statement('premium.insert_guild').execute(guild.id)
 
-        self.data.append(guild.id)
+        self.data.add(guild.id)
 
         log.debug('Added guild with ID: %s to premium list', guild.id)
 
     async def remove(self, guild: abc.Snowflake) -> None:
-        query ='UPDATE guilds_core SET premium=false WHERE guild_id=$1;'
-        await self.bot.database.execute(query, guild.id)
+        await self.bot.database.statement('premium.remove_guild').execute(guild.id)
         
-        with contextlib.suppress(ValueError):
-            self.data.remove(guild.id)
+        self.data.discard(guild.id)
 
         log.debug('Removed guild with ID: %s from premium list', guild.id)
 
 
-class UserPremium(UserList):
+class UserPremium(SnowflakeSet):
     def __init__(self, bot: ApertureBot) -> None:
         super().__init__()
         self.bot = bot
@@ -67,20 +62,16 @@ class UserPremium(UserList):
         if user.id in self.data:
             raise error.PremiumBlacklisted(user.id)
 
-        query = 'INSERT INTO users_core (user_id, blacklisted, premium) VALUES ($1, false, true) '\
-            'ON CONFLICT (user_id) DO UPDATE SET premium=true;'
-        await self.bot.database.execute(query, user.id)
+        await self.bot.database.statement('premium.insert_user').execute(user.id)
 
-        self.data.append(user.id)
+        self.data.add(user.id)
 
         log.debug('Added user with ID: %s to premium list', user.id)
 
     async def remove(self, user: abc.Snowflake) -> None:
-        query = 'UPDATE users_core SET premium=false WHERE user_id=$1;'
-        await self.bot.database.execute(query, user.id)
+        await self.bot.database.statement('premium.remove_user').execute(user.id)
         
-        with contextlib.suppress(ValueError):
-            self.data.remove(user.id)
+        self.data.discard(user.id)
 
         log.debug('Removed user with ID: %s from premium list', user.id)
 
@@ -88,18 +79,10 @@ class UserPremium(UserList):
 class Premium:
     def __init__(self, bot: ApertureBot) -> None:
         self.bot = bot
-        self.guilds: List[int] = GuildPremium(bot)
-        self.users: List[int] = UserPremium(bot)
+        self.guilds = GuildPremium(bot)
+        self.users = UserPremium(bot)
+        self._all = SnowflakeSetUnion(self.guilds, self.users)
 
     @property
-    def all(self) -> List[int]:
-        return self.guilds + self.users
-
-    async def fill(self) -> None:
-        data: List[asyncpg.Record] = await self.bot.database.fetch('SELECT guild_id FROM guilds_core WHERE premium=true;')
-        for row in data:
-            self.guilds.append(row['guild_id'])
-        data: List[asyncpg.Record] = await self.bot.database.fetch('SELECT user_id FROM users_core WHERE premium=true;')
-        for row in data:
-            self.users.append(row['user_id'])
-        log.debug('Filled premium cache')
+    def all(self) -> SnowflakeSetUnion:
+        return self._all
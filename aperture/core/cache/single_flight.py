@@ -0,0 +1,76 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Awaitable, Callable, Dict, Generic, Hashable, TypeVar
+
+import asyncio
+
+
+__all__ = ('SingleFlight', )
+
+T = TypeVar('T')
+
+
+def _consume_exception(future: asyncio.Future) -> None:
+    # Prevents "Future exception was never retrieved" when nobody else was waiting on the call
+    if not future.cancelled():
+        future.exception()
+
+
+class SingleFlight(Generic[T]):
+    """Coalesces concurrent calls for the same key into one in-flight call.
+
+    The first caller for a key runs the function, every other caller arriving while
+    it is still running awaits the same result (or exception) instead of running it again.
+    If the running caller is cancelled, one of the waiting callers runs the function instead.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        while (future := self._calls.get(key)) is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # This caller was cancelled, not the call
+                    raise
+                # The caller running the call was cancelled, the first waiter to wake up runs it again
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
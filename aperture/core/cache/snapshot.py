@@ -0,0 +1,129 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Collection, Dict, Iterable, List, NamedTuple, Optional
+
+import os
+import sys
+import mmap
+import struct
+import tempfile
+from array import array
+
+
+__all__ = ('CacheSnapshot', 'dump_snapshot', 'load_snapshot')
+
+# magic, version, byte order, blacklisted guilds, blacklisted users, premium guilds, premium users, prefixes, reserved
+HEADER = struct.Struct('=4sHH6I')
+MAGIC: bytes = b'APCS'
+VERSION: int = 1
+BYTE_ORDER: int = 1 if sys.byteorder == 'little' else 2
+
+
+class CacheSnapshot(NamedTuple):
+    blacklisted_guilds: Collection[int]
+    blacklisted_users: Collection[int]
+    premium_guilds: Collection[int]
+    premium_users: Collection[int]
+    prefixes: Dict[int, str]
+
+
+def _ids(ids: Iterable[int]) -> array:
+    return array('Q', ids)
+
+def dump_snapshot(path: str, snapshot: CacheSnapshot) -> None:
+    """Writes the snapshot to ``path`` atomically.
+
+    Layout: a fixed size header followed by native 64 bit ID arrays (blacklisted guilds, blacklisted users,
+    premium guilds, premium users, prefix guild IDs), one byte per prefix length and the UTF-8 prefixes.
+    Every array is 8 byte aligned, :func:`load_snapshot` memory maps the file and copies each array out
+    with a single ``frombytes``.
+    """
+
+    prefix_guild_ids = _ids(snapshot.prefixes.keys())
+    prefixes: List[bytes] = [prefix.encode('utf-8') for prefix in snapshot.prefixes.values()]
+    prefix_lengths = array('B', map(len, prefixes))
+
+    id_arrays: List[array] = [
+        _ids(snapshot.blacklisted_guilds), _ids(snapshot.blacklisted_users),
+        _ids(snapshot.premium_guilds), _ids(snapshot.premium_users), prefix_guild_ids
+    ]
+    header = HEADER.pack(MAGIC, VERSION, BYTE_ORDER, *map(len, id_arrays), 0)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    # A unique temporary file, so concurrent dumps (e.g. of several cluster workers) can't interleave their writes
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as file:
+            file.write(header)
+            for ids in id_arrays:
+                ids.tofile(file)
+            prefix_lengths.tofile(file)
+            file.write(b''.join(prefixes))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def load_snapshot(path: str) -> Optional[CacheSnapshot]:
+    """Loads a snapshot written by :func:`dump_snapshot`.
+    Returns ``None`` if there's no snapshot or it's unusable (other version, byte order, or truncated)."""
+
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with file:
+        if os.fstat(file.fileno()).st_size < HEADER.size:
+            return None
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with mm:
+        magic, version, byte_order, *counts, n_prefixes, _ = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION or byte_order != BYTE_ORDER:
+            return None
+
+        with memoryview(mm) as view:
+            offset = HEADER.size
+            arrays: List[array] = []
+            for count in (*counts, n_prefixes):
+                end = offset + count * 8
+                if end > len(mm):
+                    return None
+                ids = array('Q')
+                with view[offset:end] as chunk:
+                    ids.frombytes(chunk)
+                arrays.append(ids)
+                offset = end
+
+            lengths = mm[offset:offset + n_prefixes]
+            offset += n_prefixes
+            if offset + sum(lengths) > len(mm):
+                return None
+
+            prefixes: Dict[int, str] = {}
+            for guild_id, length in zip(arrays[4], lengths):
+                prefixes[guild_id] = mm[offset:offset + length].decode('utf-8')
+                offset += length
+
+    return CacheSnapshot(arrays[0], arrays[1], arrays[2], arrays[3], prefixes)
@@ -0,0 +1,80 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Any, Iterable, Iterator, Set
+
+from collections.abc import Set as AbstractSet
+
+
+__all__ = ('SnowflakeSet', 'SnowflakeSetUnion')
+
+
+class SnowflakeSet(AbstractSet):
+    """A read-only set of IDs with O(1) membership checks.
+
+    Subclasses are responsible for writing to the database before mutating ``data``.
+    """
+
+    def __init__(self) -> None:
+        self.data: Set[int] = set()
+
+    def __contains__(self, id: Any) -> bool:
+        return id in self.data
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} size={len(self.data)}>'
+
+    def update(self, ids: Iterable[int]) -> None:
+        self.data.update(ids)
+
+    def replace(self, ids: Iterable[int]) -> None:
+        # Builds the new set first, so readers never see a partially filled cache
+        self.data = set(ids)
+
+
+class SnowflakeSetUnion(AbstractSet):
+    """A non-copying view over multiple :class:`SnowflakeSet`."""
+
+    __slots__ = ('sets', )
+
+    def __init__(self, *sets: SnowflakeSet) -> None:
+        self.sets = sets
+
+    def __contains__(self, id: Any) -> bool:
+        return any(id in s.data for s in self.sets)
+
+    def __iter__(self) -> Iterator[int]:
+        seen: Set[int] = set()
+        for s in self.sets:
+            for id in s.data:
+                if id not in seen:
+                    seen.add(id)
+                    yield id
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f'<{self.__class__.__name__} sets={len(self.sets)}>'
@@ -19,15 +19,38 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 from typing import Any, Optional, TYPE_CHECKING
 
+import time
+
 from discord.ext import commands
 
 if TYPE_CHECKING:
     from discord import Message
     from aperture import ApertureBot
+    from .timings import CommandTiming
 
 class ApertureContext(commands.Context['ApertureBot']):
+    # Set when the command pipeline timings are enabled
+    timings: Optional[CommandTiming] = None
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> Message:
+        if self.timings is None:
+            return await super().send(content=content, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return await super().send(content=content, **kwargs)
+        finally:
+            self.timings.send += time.perf_counter() - start
+
     async def reply(self, content: Optional[str] = None, **kwargs: Any) -> Message:
         if not kwargs.get('mention_author', None):
             kwargs['mention_author'] = False
 
-        return await super().reply(content=content, **kwargs)
+        if self.timings is None:
+            return await super().reply(content=content, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return await super().reply(content=content, **kwargs)
+        finally:
+            self.timings.send += time.perf_counter() - start
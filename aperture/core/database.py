@@ -17,35 +17,168 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import Any, Iterable, List, Optional, Sequence
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import os
+import re
 import sys
+import time
+import hashlib
+import functools
 import asyncio
 import asyncpg
 import logging
 import traceback
+import contextlib
+
+from discord.ext import tasks
+
+from .histogram import Histogram
+from .invalidation import InvalidationBus
+from .queries import QUERIES
+from .tracing import tracer
 
 
 log = logging.getLogger('aperture.core.database')
+slow_query_log = logging.getLogger('aperture.core.database.slow')
+
+# String and numeric literals (but not $n parameters)
+LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint_query(query: str) -> Tuple[str, str]:
+    """Returns a short fingerprint of the query and the normalized query it is computed from,
+    so the same statement is grouped together regardless of whitespace and inlined literals."""
+
+    normalized = LITERAL_REGEX.sub('?', ' '.join(query.split()))
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest(), normalized
+
+def redact_args(args: Optional[Sequence[Any]]) -> str:
+    if args is None:
+        return '<batch>'
+    return ', '.join(f'<{type(arg).__name__}>' for arg in args)
+
+
+class ApertureConnection(asyncpg.Connection):
+    """Pool connection holding the statements of :data:`aperture.core.queries.QUERIES` prepared on it,
+    and counting the queries run on it."""
+
+    __slots__ = ('prepared_statements', 'query_count', 'timeout_count')
+
+    def record_query(self, timed_out: bool = False) -> None:
+        self.query_count += 1
+        if timed_out:
+            self.timeout_count += 1
+
+
+class PoolStats:
+    __slots__ = ('acquire_wait', 'acquire_timeouts', 'query_timeouts')
+
+    def __init__(self) -> None:
+        self.acquire_wait: Histogram = Histogram()
+        self.acquire_timeouts: int = 0
+        self.query_timeouts: int = 0
+
+
+class StatementStats:
+    __slots__ = ('calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self) -> None:
+        self.calls: int = 0
+        self.errors: int = 0
+        self.total_time: float = 0.0
+        self.max_time: float = 0.0
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_time': self.total_time,
+            'mean_time': self.mean_time,
+            'max_time': self.max_time,
+        }
+
+
+class QueryStats:
+    __slots__ = ('fingerprint', 'query', 'latency', 'errors')
+
+    def __init__(self, fingerprint: str, query: str) -> None:
+        self.fingerprint: str = fingerprint
+        self.query: str = query
+        self.latency: Histogram = Histogram()
+        self.errors: int = 0
+
+
+class BoundStatement:
+    """A named statement of the registry, run on any pool connection through its prepared statement.
+    Passing ``connection`` runs it on that connection instead, e.g. inside :meth:`ApertureDatabase.transaction`."""
+
+    __slots__ = ('database', 'name')
+
+    def __init__(self, database: ApertureDatabase, name: str) -> None:
+        self.database = database
+        self.name: str = name
+
+    async def execute(
+        self, *args: Any, timeout: Optional[float] = None, connection: Optional[ApertureConnection] = None
+    ) -> str:
+        return await self.database._run_statement(self.name, 'execute', args, timeout, connection)
+
+    async def executemany(
+        self, args: Iterable[Sequence], *, timeout: Optional[float] = None, connection: Optional[ApertureConnection] = None
+    ) -> None:
+        return await self.database._run_statement(self.name, 'executemany', (args, ), timeout, connection)
+
+    async def fetch(
+        self, *args: Any, timeout: Optional[float] = None, connection: Optional[ApertureConnection] = None
+    ) -> List[asyncpg.Record]:
+        return await self.database._run_statement(self.name, 'fetch', args, timeout, connection)
+
+    async def fetchrow(
+        self, *args: Any, timeout: Optional[float] = None, connection: Optional[ApertureConnection] = None
+    ) -> Optional[asyncpg.Record]:
+        return await self.database._run_statement(self.name, 'fetchrow', args, timeout, connection)
+
+    async def fetchval(
+        self, *args: Any, timeout: Optional[float] = None, connection: Optional[ApertureConnection] = None
+    ) -> Any:
+        return await self.database._run_statement(self.name, 'fetchval', args, timeout, connection)
 
 
 class ApertureDatabase:
     def __init__(self) -> None:
         self.pool: Optional[asyncpg.Pool] = None
+        self.statement_stats: Dict[str, StatementStats] = {name: StatementStats() for name in QUERIES}
+        self.pool_stats: PoolStats = PoolStats()
+        self.query_stats: Dict[str, QueryStats] = {}
+        self.slow_query_threshold: float = float(os.getenv('POSTGRES_SLOW_QUERY_THRESHOLD', 0.5))
+        # Longest wait for a pool connection before giving up with a TimeoutError
+        self.acquire_timeout: float = float(os.getenv('POSTGRES_ACQUIRE_TIMEOUT', 10))
+        self._connections: Dict[int, ApertureConnection] = {}
+        self.dsn: Optional[str] = os.getenv('POSTGRES_URL')
+        self.invalidation_bus: InvalidationBus = InvalidationBus(self)
 
     def create_pool(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> asyncpg.Pool:
         if not loop:
             loop = asyncio.get_event_loop()
 
-        DSN = os.getenv('POSTGRES_URL')
+        # The pool opens connections on demand up to ``max_size``, and closes the ones idle for more
+        # than ``max_inactive_connection_lifetime`` seconds (even below ``min_size``, they are reopened on demand)
         kwargs = {
-            'command_timeout': 60,
-            'min_size': 20,
-            'max_size': 20
+            'command_timeout': float(os.getenv('POSTGRES_COMMAND_TIMEOUT', 60)),
+            'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', 5)),
+            'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE', 20)),
+            'max_inactive_connection_lifetime': float(os.getenv('POSTGRES_POOL_MAX_IDLE', 300)),
+            'connection_class': ApertureConnection,
+            'init': self._init_connection,
         }
         try:
-            pool: asyncpg.Pool = loop.run_until_complete(asyncpg.create_pool(DSN, **kwargs))
+            pool: asyncpg.Pool = loop.run_until_complete(asyncpg.create_pool(self.dsn, **kwargs))
             log.debug('Created database pool')
             self.pool = pool
             return pool
@@ -54,19 +187,226 @@ class ApertureDatabase:
             traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
             raise RuntimeError('Failed to create database pool. Exiting...')
 
+    @staticmethod
+    async def _prepare(connection: ApertureConnection, name: str) -> asyncpg.prepared_stmt.PreparedStatement:
+        statement = await connection.prepare(QUERIES[name])
+        connection.prepared_statements[name] = statement
+        return statement
+
+    async def _init_connection(self, connection: ApertureConnection) -> None:
+        connection.prepared_statements = {}
+        connection.query_count = 0
+        connection.timeout_count = 0
+        self._connections[id(connection)] = connection
+
+        for name in QUERIES:
+            try:
+                await self._prepare(connection, name)
+            except asyncpg.UndefinedTableError:
+                # The schema isn't migrated yet, the statement is prepared on its first use instead
+                pass
+
+    def statement(self, name: str) -> BoundStatement:
+        if name not in QUERIES:
+            raise KeyError(f'No statement named {name!r} in the query registry')
+        return BoundStatement(self, name)
+
+    async def _run_statement(
+        self,
+        name: str,
+        method: str,
+        args: Sequence[Any],
+        timeout: Optional[float],
+        connection: Optional[ApertureConnection] = None
+    ) -> Any:
+        stats = self.statement_stats[name]
+        with tracer.span('db', statement=name, method=method):
+            async with self._use_connection(connection) as connection:
+                start = time.perf_counter()
+                try:
+                    for attempt in range(2):
+                        statement = connection.prepared_statements.get(name)
+                        if statement is None:
+                            statement = await self._prepare(connection, name)
+                        try:
+                            if method == 'execute':
+                                await statement.fetch(*args, timeout=timeout)
+                                return statement.get_statusmsg()
+                            return await getattr(statement, method)(*args, timeout=timeout)
+                        except asyncpg.InvalidCachedStatementError:
+                            # The schema changed under the prepared statement (e.g. by a migration), prepare it again
+                            connection.prepared_statements.pop(name, None)
+                            if attempt:
+                                raise
+                except asyncio.TimeoutError:
+                    stats.errors += 1
+                    self.pool_stats.query_timeouts += 1
+                    connection.record_query(timed_out=True)
+                    failed = True
+                    raise
+                except BaseException:
+                    stats.errors += 1
+                    connection.record_query()
+                    failed = True
+                    raise
+                else:
+                    connection.record_query()
+                    failed = False
+                finally:
+                    elapsed = time.perf_counter() - start
+                    stats.calls += 1
+                    stats.total_time += elapsed
+                    if elapsed > stats.max_time:
+                        stats.max_time = elapsed
+                    self._trace(QUERIES[name], elapsed, None if method == 'executemany' else args, failed)
+
+    def get_statement_stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: stats.to_dict() for name, stats in self.statement_stats.items() if stats.calls}
+
     async def close_pool(self):
+        await self.invalidation_bus.close()
+
         if self.pool is not None:
             await self.pool.close()
             log.debug('Closed database pool')
 
+    @contextlib.asynccontextmanager
+    async def acquire(self, *, timeout: Optional[float] = None) -> AsyncIterator[asyncpg.pool.PoolConnectionProxy]:
+        if timeout is None:
+            timeout = self.acquire_timeout
+        start = time.perf_counter()
+        try:
+            with tracer.span('db.acquire'):
+                connection = await self.pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            self.pool_stats.acquire_timeouts += 1
+            raise
+        self.pool_stats.acquire_wait.observe(time.perf_counter() - start)
+
+        try:
+            yield connection
+        finally:
+            await self.pool.release(connection)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self) -> AsyncIterator[asyncpg.pool.PoolConnectionProxy]:
+        """Acquires a connection and opens a transaction on it, committed when the block exits
+        without an exception. Pass the connection to the statements which should run in it."""
+
+        async with self.acquire() as connection:
+            async with connection.transaction():
+                yield connection
+
+    @contextlib.asynccontextmanager
+    async def _use_connection(self, connection: Optional[ApertureConnection]) -> AsyncIterator[ApertureConnection]:
+        if connection is not None:
+            # Borrowed from the caller (e.g. a transaction), it is released by them
+            yield connection
+            return
+        async with self.acquire(timeout=self.acquire_timeout) as connection:
+            yield connection
+
+    def _trace(self, query: str, elapsed: float, args: Optional[Sequence[Any]], failed: bool) -> None:
+        fingerprint, normalized = fingerprint_query(query)
+        stats = self.query_stats.get(fingerprint)
+        if stats is None:
+            stats = self.query_stats[fingerprint] = QueryStats(fingerprint, normalized)
+        stats.latency.observe(elapsed)
+        if failed:
+            stats.errors += 1
+
+        if elapsed >= self.slow_query_threshold:
+            # Arguments may hold user data, only their types are logged
+            slow_query_log.warning(
+                'Slow query (%.3fs) [%s]: %s | Arguments: %s', elapsed, fingerprint, normalized, redact_args(args)
+            )
+
+    async def _query(
+        self, method: str, query: str, *args: Any, connection: Optional[ApertureConnection] = None, **kwargs: Any
+    ) -> Any:
+        traced = f'COPY {query}' if method == 'copy_records_to_table' else query
+        with tracer.span('db', fingerprint=fingerprint_query(traced)[0], method=method):
+            async with self._use_connection(connection) as connection:
+                start = time.perf_counter()
+                failed = True
+                timed_out = False
+                try:
+                    result = await getattr(connection, method)(query, *args, **kwargs)
+                    failed = False
+                except asyncio.TimeoutError:
+                    self.pool_stats.query_timeouts += 1
+                    timed_out = True
+                    raise
+                finally:
+                    # Failed queries (and cancelled ones) count too
+                    connection.record_query(timed_out=timed_out)
+                    traced_args = None if method in ('copy_records_to_table', 'executemany') else args
+                    self._trace(traced, time.perf_counter() - start, traced_args, failed)
+                return result
+
     async def execute(self, query: str, *args: Any) -> str:
-        return await self.pool.execute(query, *args)
+        return await self._query('execute', query, *args)
 
     async def executemany(self, query: str, args: Iterable[Sequence], timeout: Optional[float] = None):
-        return await self.pool.executemany(query, args, timeout=timeout)
+        return await self._query('executemany', query, args, timeout=timeout)
 
     async def fetch(self, query: str, *args: Any, timeout: Optional[float] = None) -> List[asyncpg.Record]:
-        return await self.pool.fetch(query, *args, timeout=timeout)
+        return await self._query('fetch', query, *args, timeout=timeout)
 
     async def fetchrow(self, query: str, *args: Any, timeout: Optional[float] = None) -> Optional[asyncpg.Record]:
-        return await self.pool.fetchrow(query, *args, timeout=timeout)
+        return await self._query('fetchrow', query, *args, timeout=timeout)
+
+    async def copy_records_to_table(
+        self,
+        table_name: str,
+        *,
+        records: Iterable[Sequence],
+        columns: Optional[Sequence[str]] = None,
+        timeout: Optional[float] = None,
+        connection: Optional[ApertureConnection] = None
+    ) -> str:
+        return await self._query(
+            'copy_records_to_table', table_name, records=records, columns=columns, timeout=timeout, connection=connection
+        )
+
+    def top_queries(self, limit: int = 10) -> List[QueryStats]:
+        """Returns the ``limit`` queries with the highest total execution time."""
+
+        return sorted(self.query_stats.values(), key=lambda stats: stats.latency.sum, reverse=True)[:limit]
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        # Forget the connections the pool closed (e.g. idle ones above ``min_size``)
+        for key, connection in list(self._connections.items()):
+            if connection.is_closed():
+                del self._connections[key]
+
+        size = self.pool.get_size() if self.pool is not None else 0
+        idle = self.pool.get_idle_size() if self.pool is not None else 0
+        return {
+            'size': size,
+            'in_use': size - idle,
+            'idle': idle,
+            'min_size': self.pool.get_min_size() if self.pool is not None else 0,
+            'max_size': self.pool.get_max_size() if self.pool is not None else 0,
+            'acquire_wait': self.pool_stats.acquire_wait.to_dict(),
+            'acquire_timeouts': self.pool_stats.acquire_timeouts,
+            'query_timeouts': self.pool_stats.query_timeouts,
+            'connections': [
+                {'queries': connection.query_count, 'timeouts': connection.timeout_count}
+                for connection in self._connections.values()
+            ],
+        }
+
+    def log_pool_stats(self) -> None:
+        stats = self.get_pool_stats()
+        wait = stats['acquire_wait']
+        log.info(
+            'Pool stats: size %s/%s (in use: %s, idle: %s), acquire wait p50: %s, p99: %s, max: %.4fs, '
+            'acquire timeouts: %s, query timeouts: %s',
+            stats['size'], stats['max_size'], stats['in_use'], stats['idle'],
+            wait['p50'], wait['p99'], wait['max'], stats['acquire_timeouts'], stats['query_timeouts']
+        )
+
+    @tasks.loop(minutes=5)
+    async def stats_task(self) -> None:
+        self.log_pool_stats()
@@ -38,3 +38,19 @@ class PremiumBlacklisted(CacheError):
             'You need to remove them from blacklist first to add them to premium' 
         
         super().__init__(message, *args)
+
+
+class DatabaseError(ApertureError):
+    """All the errors raised on Database handling."""
+    pass
+
+class MigrationChecksumMismatch(DatabaseError):
+    """An already applied migration file has been modified"""
+
+    def __init__(self, version: int, name: str, *args: Any) -> None:
+        self.version: int = version
+        self.name: str = name
+        message = f'The migration {version:04d}_{name}.sql has been modified after it was applied. '\
+            'Applied migrations must never be edited, add a new migration instead'
+
+        super().__init__(message, *args)
@@ -0,0 +1,81 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from bisect import bisect_left
+
+
+__all__ = ('Histogram', 'LATENCY_BUCKETS')
+
+# Upper bounds (in seconds) suited for latencies from a fraction of a millisecond to a minute
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+
+class Histogram:
+    """A fixed bucket histogram. Observing a value is a binary search and two additions."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        # The last count is for values above the biggest bucket
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Returns the upper bound of the bucket holding the ``q`` (0-100) percentile,
+        the biggest observed value if it's above every bucket, or ``None`` if nothing was observed."""
+
+        if not self.count:
+            return None
+
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return self.max
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
@@ -0,0 +1,178 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
+
+import json
+import asyncio
+import asyncpg
+import logging
+
+if TYPE_CHECKING:
+    from .database import ApertureDatabase
+
+
+__all__ = ('Invalidation', 'InvalidationBus')
+
+log = logging.getLogger('aperture.core.database')
+
+# Channel the triggers of migrations/0003_cache_invalidation.sql notify on
+CHANNEL: str = 'aperture_cache_invalidation'
+
+
+class Invalidation(NamedTuple):
+    table: str
+    op: str
+    row: Dict[str, Any]
+
+
+# Called with the batch of invalidations, or with ``resync=True`` (and an empty batch) when
+# notifications may have been missed and the whole cache has to be refetched
+InvalidationSubscriber = Callable[[List[Invalidation], bool], Awaitable[None]]
+
+
+class InvalidationBus:
+    """Listens for cache invalidations notified by the database triggers on a dedicated connection.
+
+    Notifications are coalesced per row (only the latest state of a row is kept) and delivered to the
+    subscribers in batches, at most once every ``debounce`` seconds. If the listener connection drops (or stops
+    answering the ``SELECT 1`` run every ``keepalive_interval`` seconds), it reconnects with a backoff and asks
+    the subscribers to resync since notifications may have been lost.
+    """
+
+    def __init__(
+        self,
+        database: ApertureDatabase,
+        *,
+        debounce: float = 0.25,
+        keepalive_interval: float = 30.0,
+        keepalive_timeout: float = 10.0
+    ) -> None:
+        self.database = database
+        self.debounce: float = debounce
+        self.keepalive_interval: float = keepalive_interval
+        self.keepalive_timeout: float = keepalive_timeout
+
+        self._subscribers: List[InvalidationSubscriber] = []
+        self._pending: Dict[Tuple[str, Any], Invalidation] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connection: Optional[asyncpg.Connection] = None
+        self._closed: bool = False
+
+    def subscribe(self, subscriber: InvalidationSubscriber) -> None:
+        self._subscribers.append(subscriber)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        log.debug('Closed cache invalidation bus')
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        backoff: float = 1.0
+        connected_before: bool = False
+
+        while not self._closed:
+            connection: Optional[asyncpg.Connection] = None
+            failed: bool = False
+            try:
+                connection = await asyncpg.connect(self.database.dsn)
+                lost = loop.create_future()
+                connection.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await connection.add_listener(CHANNEL, self._on_notification)
+                self._connection = connection
+                backoff = 1.0
+                log.debug('Listening for cache invalidations')
+
+                if connected_before:
+                    # We may have missed notifications while disconnected
+                    self._dispatch([], resync=True)
+                connected_before = True
+
+                await self._keepalive(connection, lost)
+                log.warning('Lost the cache invalidation listener connection, reconnecting')
+            except Exception as e:
+                failed = True
+                log.warning('Cache invalidation listener failed, reconnecting in %ss', backoff, exc_info=e)
+            finally:
+                self._connection = None
+                if connection is not None and not connection.is_closed():
+                    if failed:
+                        # The connection may be half-open, a graceful close would wait on it
+                        connection.terminate()
+                    else:
+                        await connection.close()
+
+            if failed:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    async def _keepalive(self, connection: asyncpg.Connection, lost: asyncio.Future) -> None:
+        """Waits until the connection is lost, running ``SELECT 1`` on it every ``keepalive_interval`` seconds
+        so a half-open connection (which would never be reported as lost) times out instead."""
+
+        while True:
+            done, _ = await asyncio.wait((lost, ), timeout=self.keepalive_interval)
+            if done:
+                return
+            await connection.fetchval('SELECT 1;', timeout=self.keepalive_timeout)
+
+    def _on_notification(self, _: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            data = json.loads(payload)
+            row: Dict[str, Any] = data['row']
+            key = row.get('guild_id', row.get('user_id'))
+            invalidation = Invalidation(data['table'], data['op'], row)
+        except (ValueError, KeyError, AttributeError):
+            log.warning('Received malformed cache invalidation payload: %s', payload)
+            return
+
+        self._pending[(invalidation.table, key)] = invalidation
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.debounce, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        batch, self._pending = list(self._pending.values()), {}
+        if batch:
+            self._dispatch(batch, resync=False)
+
+    def _dispatch(self, batch: List[Invalidation], resync: bool) -> None:
+        for subscriber in self._subscribers:
+            task = asyncio.create_task(subscriber(batch, resync))
+            task.add_done_callback(self._log_subscriber_error)
+
+    @staticmethod
+    def _log_subscriber_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Cache invalidation subscriber failed', exc_info=task.exception())
@@ -38,11 +38,11 @@ async def on_message(bot: ApertureBot, message: discord.Message) -> None:
 
 async def on_guild_join(bot: ApertureBot, guild: discord.Guild) -> None:
     log.debug('Joined a guild. ID: %s', guild.id)
-    await bot.cache.insert_prefix(bot._default_prefix, guild)
+    bot.cache.prefix.queue_insert(bot._default_prefix, guild)
 
 async def on_guild_remove(bot: ApertureBot, guild: discord.Guild) -> None:
     log.debug('Left a guild. ID: %s', guild.id)
-    await bot.cache.remove_prefix(guild)
+    bot.cache.prefix.queue_remove(guild)
 
 async def on_command(ctx: ApertureContext):
     bot: ApertureBot = ctx.bot
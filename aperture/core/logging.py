@@ -17,9 +17,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
 
+import os
+import json
+import time
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 
 __all__ = ('ApertureLogger', )
@@ -34,12 +40,128 @@ class RemoveNoise(logging.Filter):
             return False
         return True
 
+
+class SamplingFilter(logging.Filter):
+    """Lets at most ``rate`` records at or below ``level`` through every ``per`` seconds.
+
+    The next record let through after some were dropped tells how many were."""
+
+    def __init__(self, rate: int, per: float, level: int = logging.DEBUG) -> None:
+        super().__init__()
+        self.rate: int = rate
+        self.per: float = per
+        self.level: int = level
+        self.tokens: float = float(rate)
+        self.updated: float = time.monotonic()
+        self.suppressed: int = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = f'{record.msg} [{suppressed} similar records sampled out]'
+        return True
+
+    @staticmethod
+    def parse(spec: str) -> Dict[str, Tuple[int, float]]:
+        """Parses ``logger=rate/per`` pairs separated by commas, e.g. ``aperture.core.listeners=10/1``."""
+
+        rates: Dict[str, Tuple[int, float]] = {}
+        for item in filter(None, (part.strip() for part in spec.split(','))):
+            name, _, rate = item.partition('=')
+            count, _, per = rate.partition('/')
+            rates[name.strip()] = (int(count), float(per or 1))
+        return rates
+
+
+class WorkerLogFilter(logging.Filter):
+    """Prefixes the logger name of the records with the cluster worker they come from."""
+
+    def __init__(self, worker_id: int) -> None:
+        super().__init__()
+        self.worker_id: int = worker_id
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.name = f'worker-{self.worker_id}.{record.name}'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload: Dict[str, Any] = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if getattr(record, 'suppressed', None):
+            payload['suppressed'] = record.suppressed
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class LocalQueueHandler(QueueHandler):
+    """Puts the records on an in-process queue without formatting them, the listener thread does it."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments now, they might be mutated before the listener gets to the record
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
 class ApertureLogger:
-    def __init__(self, log_discord: bool = True, enable_bot_debug: bool = False) -> None:
+    def __init__(
+        self,
+        log_discord: bool = True,
+        enable_bot_debug: bool = False,
+        queue: Optional[Any] = None,
+        *,
+        worker_id: Optional[int] = None,
+        background: Optional[bool] = None,
+        json_output: Optional[bool] = None,
+        sampling: Optional[str] = None
+    ) -> None:
+        """If ``queue`` is given, records are put on it (e.g. for the cluster supervisor to write them)
+        instead of being written to the log file by this process, tagged with ``worker_id`` if given.
+
+        With ``background`` (``LOG_BACKGROUND``, on by default), the files are written by a listener thread
+        instead of the thread logging the record. ``json_output`` (``LOG_JSON``) writes one JSON object per
+        record and ``sampling`` (``LOG_SAMPLING``) rate limits the debug records of the given loggers."""
+
         self.log_discord: bool = log_discord
         self.enable_bot_debug: bool = enable_bot_debug
+        self.queue: Optional[Any] = queue
+        self.worker_id: Optional[int] = worker_id
+        self.background: bool = background if background is not None else os.getenv('LOG_BACKGROUND', 'true').lower() == 'true'
+        self.json_output: bool = json_output if json_output is not None else os.getenv('LOG_JSON', 'false').lower() == 'true'
+        self.sampling: Dict[str, Tuple[int, float]] = SamplingFilter.parse(
+            sampling if sampling is not None else os.getenv('LOG_SAMPLING', '')
+        )
         self.max_bytes: int = 64 * 1024 * 1024 # 64 MiB
         self.log: logging.Logger = logging.getLogger()
+        self.slow_query_log: logging.Logger = logging.getLogger('aperture.core.database.slow')
+        self.listener: Optional[QueueListener] = None
+        self._sampling_filters: List[Tuple[logging.Logger, SamplingFilter]] = []
 
     def __enter__(self) -> None:
         if self.log_discord is True:
@@ -53,7 +175,21 @@ class ApertureLogger:
             logging.getLogger('aperture.core.database').setLevel(logging.DEBUG)
             logging.getLogger('aperture.core.listeners').setLevel(logging.DEBUG)
 
+        # Sampled records are dropped before reaching any handler (or queue)
+        for name, (rate, per) in self.sampling.items():
+            logger, sampling_filter = logging.getLogger(name), SamplingFilter(rate, per)
+            logger.addFilter(sampling_filter)
+            self._sampling_filters.append((logger, sampling_filter))
+
         self.log.setLevel(logging.INFO)
+        if self.queue is not None:
+            queue_handler = QueueHandler(self.queue)
+            # On the handler, logger filters don't run for the records propagated from the child loggers
+            if self.worker_id is not None:
+                queue_handler.addFilter(WorkerLogFilter(self.worker_id))
+            self.log.addHandler(queue_handler)
+            return
+
         handler = RotatingFileHandler(
             filename='./tmp/aperture.log',
             encoding='utf-8',
@@ -62,12 +198,48 @@ class ApertureLogger:
             backupCount=5
         )
         dt_fmt: str = '%Y-%m-%d %H:%M:%S'
-        fmt = logging.Formatter('[{asctime}] [{levelname:<7}] {name}: {message}', dt_fmt, style='{')
+        if self.json_output:
+            fmt = JsonFormatter()
+        else:
+            fmt = logging.Formatter('[{asctime}] [{levelname:<7}] {name}: {message}', dt_fmt, style='{')
         handler.setFormatter(fmt)
-        self.log.addHandler(handler)
+
+        # Dedicated log of the queries slower than ``POSTGRES_SLOW_QUERY_THRESHOLD``
+        slow_query_handler = RotatingFileHandler(
+            filename='./tmp/slow_queries.log',
+            encoding='utf-8',
+            mode='a',
+            maxBytes=self.max_bytes,
+            backupCount=2
+        )
+        slow_query_handler.setFormatter(fmt)
+
+        if not self.background:
+            self.log.addHandler(handler)
+            self.slow_query_log.addHandler(slow_query_handler)
+            return
+
+        # The slow queries reach the root logger too, the listener routes them to their file by name
+        slow_query_handler.addFilter(logging.Filter(self.slow_query_log.name))
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.log.addHandler(LocalQueueHandler(log_queue))
+        self.listener = QueueListener(log_queue, handler, slow_query_handler, respect_handler_level=True)
+        self.listener.start()
 
     def __exit__(self, *_) -> None:
-        handlers = self.log.handlers[:]
-        for handler in handlers:
-            handler.close()
-            self.log.removeHandler(handler)
+        if self.listener is not None:
+            # Writes the records still in the queue
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
+        for logger, sampling_filter in self._sampling_filters:
+            logger.removeFilter(sampling_filter)
+        self._sampling_filters.clear()
+
+        for logger in (self.log, self.slow_query_log):
+            handlers = logger.handlers[:]
+            for handler in handlers:
+                handler.close()
+                logger.removeHandler(handler)
@@ -0,0 +1,213 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import math
+import logging
+
+from aiohttp import web
+
+from .histogram import Histogram, LATENCY_BUCKETS
+
+
+__all__ = ('ApertureMetrics', 'Counter', 'Gauge', 'HistogramMetric', 'MetricsServer')
+
+log = logging.getLogger(__name__)
+
+Labels = Tuple[str, ...]
+Collector = Callable[[], Iterable['Metric']]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type: str = 'untyped'
+
+    __slots__ = ('name', 'documentation', 'labelnames')
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+
+    def _labels(self, values: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labelnames, values)]
+        if extra is not None:
+            pairs.append(f'{extra[0]}="{extra[1]}"')
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type}'
+        yield from self.samples()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    __slots__ = ('values', )
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in self.values.items():
+            yield f'{self.name}{self._labels(labels)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    __slots__ = ()
+
+    def set(self, value: float, *labels: str) -> None:
+        self.values[labels] = value
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+
+    __slots__ = ('buckets', 'children')
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self.children: Dict[Labels, Histogram] = {}
+
+    @classmethod
+    def from_histogram(cls, name: str, documentation: str, histogram: Histogram) -> HistogramMetric:
+        """Exposes an existing histogram (e.g. the pool's acquire wait) without copying it."""
+
+        metric = cls(name, documentation, buckets=histogram.buckets)
+        metric.children[()] = histogram
+        return metric
+
+    def observe(self, value: float, *labels: str) -> None:
+        histogram = self.children.get(labels)
+        if histogram is None:
+            histogram = self.children[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def samples(self) -> Iterator[str]:
+        for labels, histogram in self.children.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self._labels(labels, ("le", _format_value(bound)))} {cumulative}'
+            yield f'{self.name}_bucket{self._labels(labels, ("le", "+Inf"))} {histogram.count}'
+            yield f'{self.name}_sum{self._labels(labels)} {_format_value(histogram.sum)}'
+            yield f'{self.name}_count{self._labels(labels)} {histogram.count}'
+
+
+class ApertureMetrics:
+    """In-process metrics registry, exposed in the Prometheus text format.
+
+    Recording a value is a dictionary update (and a binary search for histograms), cheap enough
+    for the per-message path. Values which already live somewhere else (pool size, queue depths,
+    gateway latencies) are read by collectors, only when the metrics are scraped.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Collector] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            existing = self.metrics[metric.name]
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f'Metric {metric.name} is already registered with another type or labels')
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames)) # type: ignore
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames)) # type: ignore
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> HistogramMetric:
+        return self._register(HistogramMetric(name, documentation, labelnames, buckets)) # type: ignore
+
+    def add_collector(self, collector: Collector) -> None:
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector: Collector) -> None:
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            try:
+                for metric in collector():
+                    lines.extend(metric.render())
+            except Exception as e:
+                log.error('Metrics collector %r failed', collector, exc_info=e)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricsServer:
+    """Serves the metrics on ``GET /metrics``. Binds to localhost unless told otherwise."""
+
+    def __init__(self, metrics: ApertureMetrics, *, host: str = '127.0.0.1', port: int = 9100) -> None:
+        self.metrics: ApertureMetrics = metrics
+        self.host: str = host
+        self.port: int = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, _: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
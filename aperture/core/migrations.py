@@ -0,0 +1,127 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Dict, List, NamedTuple, Optional
+
+import os
+import re
+import asyncio
+import asyncpg
+import hashlib
+import logging
+
+from .database import ApertureDatabase
+from .error import MigrationChecksumMismatch
+
+
+__all__ = ('ApertureMigrator', )
+
+log = logging.getLogger('aperture.core.database')
+
+MIGRATION_FILE_REGEX = re.compile(r'^(?P<version>\d+)_(?P<name>\w+)\.sql$')
+
+# Arbitrary key for pg_advisory_xact_lock, so multiple processes booting together don't migrate twice
+MIGRATION_LOCK_KEY: int = 0x61706572
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    query: str
+    checksum: str
+
+
+class ApertureMigrator:
+    """Applies the numbered ``.sql`` files of ``directory`` in order.
+
+    Every migration runs in its own transaction and is recorded in ``schema_migrations`` together with
+    the SHA-256 checksum of the file. Already applied migrations are skipped after a single query,
+    and a changed checksum of an applied migration raises :exc:`MigrationChecksumMismatch`.
+    """
+
+    def __init__(self, database: ApertureDatabase, directory: str = './migrations') -> None:
+        self.database = database
+        self.directory: str = directory
+
+    def _load_migrations(self) -> List[Migration]:
+        migrations: List[Migration] = []
+        for filename in os.listdir(self.directory):
+            match = MIGRATION_FILE_REGEX.match(filename)
+            if match is None:
+                continue
+            with open(os.path.join(self.directory, filename), 'r', encoding='utf-8') as sql_file:
+                query = sql_file.read()
+            checksum = hashlib.sha256(query.encode('utf-8')).hexdigest()
+            migrations.append(Migration(int(match.group('version')), match.group('name'), query, checksum))
+
+        migrations.sort(key=lambda m: m.version)
+        return migrations
+
+    async def _applied_migrations(self) -> Dict[int, str]:
+        await self.database.execute(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'version INTEGER NOT NULL PRIMARY KEY, name TEXT NOT NULL, checksum CHAR(64) NOT NULL, '
+            'applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now());'
+        )
+        data: List[asyncpg.Record] = await self.database.fetch('SELECT version, checksum FROM schema_migrations;')
+        return {row['version']: row['checksum'] for row in data}
+
+    async def _apply(self, migration: Migration) -> bool:
+        async with self.database.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute('SELECT pg_advisory_xact_lock($1);', MIGRATION_LOCK_KEY)
+
+                # Another process may have applied it while we were waiting for the lock
+                checksum: Optional[str] = await connection.fetchval(
+                    'SELECT checksum FROM schema_migrations WHERE version=$1;', migration.version
+                )
+                if checksum is not None:
+                    if checksum != migration.checksum:
+                        raise MigrationChecksumMismatch(migration.version, migration.name)
+                    return False
+
+                await connection.execute(migration.query)
+                await connection.execute(
+                    'INSERT INTO schema_migrations (version, name, checksum) VALUES ($1, $2, $3);',
+                    migration.version, migration.name, migration.checksum
+                )
+        return True
+
+    async def migrate(self) -> int:
+        """Applies all pending migrations. Returns the number of migrations applied."""
+
+        loop = asyncio.get_running_loop()
+        # Keep the file I/O off the event loop
+        migrations = await loop.run_in_executor(None, self._load_migrations)
+        applied = await self._applied_migrations()
+
+        count = 0
+        for migration in migrations:
+            checksum = applied.get(migration.version)
+            if checksum is not None:
+                if checksum != migration.checksum:
+                    raise MigrationChecksumMismatch(migration.version, migration.name)
+                continue
+
+            if await self._apply(migration):
+                count += 1
+                log.info('Applied database migration %04d_%s', migration.version, migration.name)
+
+        log.debug('Database is up to date (%s migrations applied, %s total)', count, len(migrations))
+        return count
@@ -0,0 +1,115 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+
+import sys
+import time
+import threading
+import tracemalloc
+from types import CodeType
+from collections import Counter
+
+
+__all__ = ('SamplingProfiler', )
+
+
+class SamplingProfiler:
+    """Statistical profiler sampling the stacks of every thread of the process.
+
+    Every ``interval`` seconds the stacks of all threads are read through ``sys._current_frames()`` and counted
+    as collapsed stacks (``thread;outer;...;inner count`` lines, as read by flamegraph.pl, speedscope, ...).
+    Only one sample is taken at a time and nothing is traced between samples, so the overhead is the time
+    taken to walk the stacks, about 1% at the default 100 samples per second. With ``memory``, the allocations
+    are also traced with ``tracemalloc`` during the run (which is much more expensive), and diffed.
+    """
+
+    def __init__(self, *, interval: float = 0.01, max_depth: int = 128) -> None:
+        self.interval: float = interval
+        self.max_depth: int = max_depth
+        self.stacks: Counter[str] = Counter()
+        self.samples: int = 0
+        self.elapsed: float = 0.0
+        self.memory_diff: Optional[List[str]] = None
+        self._labels: Dict[CodeType, str] = {}
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'.replace(';', ':')
+        return label
+
+    def _sample(self, own_thread: int, thread_names: Dict[int, str]) -> None:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+
+            labels: List[str] = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            labels.append(thread_names.get(thread_id, f'thread-{thread_id}'))
+            labels.reverse()
+            self.stacks[';'.join(labels)] += 1
+        self.samples += 1
+
+    def run(self, duration: float, *, memory: bool = False) -> None:
+        """Samples for ``duration`` seconds, blocking the calling thread (not the one being profiled)."""
+
+        started_tracemalloc = False
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                started_tracemalloc = True
+            before = tracemalloc.take_snapshot()
+
+        own_thread = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + duration
+        next_sample = start
+        try:
+            while (now := time.perf_counter()) < deadline:
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                self._sample(own_thread, thread_names)
+                next_sample += self.interval
+                if next_sample > now:
+                    time.sleep(next_sample - now)
+                else:
+                    # Sampling took longer than the interval, don't try to catch up
+                    next_sample = now
+        finally:
+            self.elapsed = time.perf_counter() - start
+            if memory:
+                after = tracemalloc.take_snapshot()
+                if started_tracemalloc:
+                    tracemalloc.stop()
+                filters = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+                diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+                self.memory_diff = [str(stat) for stat in diff[:50]]
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 10) -> List[Tuple[str, int]]:
+        """Returns the functions the threads were sampled in (self time), the most sampled first."""
+
+        leaves: Counter[str] = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(limit)
@@ -0,0 +1,76 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Dict
+
+
+__all__ = ('QUERIES', )
+
+
+# Every statement the bot runs against its own tables lives here. They're prepared on each pool connection
+# and called by name through ``ApertureDatabase.statement``, so hot statements skip the parse/plan step.
+QUERIES: Dict[str, str] = {
+    # Prefixes
+    'prefix.get': 'SELECT guild_id, prefix FROM prefixes WHERE guild_id=$1;',
+    'prefix.get_or_insert': """WITH inserted AS (
+            INSERT INTO prefixes (guild_id, prefix) VALUES ($1, $2) ON CONFLICT (guild_id) DO NOTHING RETURNING prefix
+        )
+        SELECT prefix, true AS inserted FROM inserted
+        UNION ALL
+        SELECT prefix, false AS inserted FROM prefixes WHERE guild_id=$1;""",
+    'prefix.upsert': 'INSERT INTO prefixes (prefix, guild_id) VALUES ($1, $2) '
+        'ON CONFLICT (guild_id) DO UPDATE SET prefix=EXCLUDED.prefix;',
+    'prefix.delete': 'DELETE FROM prefixes WHERE guild_id=$1;',
+    'prefix.all': 'SELECT guild_id, prefix FROM prefixes;',
+    'prefix.insert_many': 'INSERT INTO prefixes (guild_id, prefix) SELECT * FROM unnest($1::bigint[], $2::varchar[]) '
+        'ON CONFLICT (guild_id) DO NOTHING;',
+    'prefix.delete_many': 'DELETE FROM prefixes WHERE guild_id=ANY($1::bigint[]);',
+
+    # Blacklist
+    'blacklist.insert_guild': 'INSERT INTO guilds_core (guild_id, blacklisted, premium) VALUES ($1, true, false) '
+        'ON CONFLICT (guild_id) DO UPDATE SET blacklisted=true;',
+    'blacklist.remove_guild': 'UPDATE guilds_core SET blacklisted=false WHERE guild_id=$1;',
+    'blacklist.insert_user': 'INSERT INTO users_core (user_id, blacklisted, premium) VALUES ($1, true, false) '
+        'ON CONFLICT (user_id) DO UPDATE SET blacklisted=true;',
+    'blacklist.remove_user': 'UPDATE users_core SET blacklisted=false WHERE user_id=$1;',
+
+    # Premium
+    'premium.insert_guild': 'INSERT INTO guilds_core (guild_id, blacklisted, premium) VALUES ($1, false, true) '
+        'ON CONFLICT (guild_id) DO UPDATE SET premium=true;',
+    'premium.remove_guild': 'UPDATE guilds_core SET premium=false WHERE guild_id=$1;',
+    'premium.insert_user': 'INSERT INTO users_core (user_id, blacklisted, premium) VALUES ($1, false, true) '
+        'ON CONFLICT (user_id) DO UPDATE SET premium=true;',
+    'premium.remove_user': 'UPDATE users_core SET premium=false WHERE user_id=$1;',
+
+    # Blacklisted and premium guilds/users at once, for warming up the cache
+    'core.flagged': 'SELECT guild_id AS id, true AS is_guild, blacklisted, premium FROM guilds_core '
+        'WHERE blacklisted=true OR premium=true '
+        'UNION ALL SELECT user_id, false, blacklisted, premium FROM users_core '
+        'WHERE blacklisted=true OR premium=true;',
+
+    # Command usage
+    'command_stats.upsert_minutely': 'INSERT INTO command_stats_minutely (bucket, name, type, guild_id, uses) '
+        'SELECT * FROM unnest($1::timestamptz[], $2::varchar[], $3::smallint[], $4::bigint[], $5::integer[]) '
+        'ON CONFLICT (bucket, name, type, guild_id) DO UPDATE SET uses=command_stats_minutely.uses + EXCLUDED.uses;',
+    'command_stats.upsert_hourly': 'INSERT INTO command_stats_hourly (bucket, name, type, guild_id, uses) '
+        'SELECT * FROM unnest($1::timestamptz[], $2::varchar[], $3::smallint[], $4::bigint[], $5::integer[]) '
+        'ON CONFLICT (bucket, name, type, guild_id) DO UPDATE SET uses=command_stats_hourly.uses + EXCLUDED.uses;',
+    'command_stats.top': 'SELECT name, SUM(uses)::bigint AS uses FROM command_stats_hourly WHERE bucket >= $1 '
+        'AND ($2::bigint IS NULL OR guild_id=$2) GROUP BY name;',
+}
@@ -0,0 +1,115 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+
+import json
+import time
+from contextvars import ContextVar
+
+from .histogram import Histogram
+
+
+__all__ = ('STAGES', 'CommandTiming', 'PipelineTimings', 'current_timing')
+
+# In the order they run
+STAGES: Tuple[str, ...] = ('prefix', 'context', 'checks', 'prepare', 'callback', 'send', 'total')
+
+# The timing of the message being processed in the current task, so ``get_prefix`` can fill its stage
+current_timing: ContextVar[Optional[CommandTiming]] = ContextVar('current_timing', default=None)
+
+
+class CommandTiming:
+    """Stage durations (in seconds) of a single invocation.
+
+    ``prepare`` covers the command checks, cooldowns, max concurrency and argument parsing,
+    ``callback`` excludes the time spent sending messages, which goes in ``send``."""
+
+    __slots__ = ('started', 'mark', 'prefix', 'context', 'checks', 'prepare', 'callback', 'send')
+
+    def __init__(self) -> None:
+        self.started: float = time.perf_counter()
+        self.mark: float = self.started
+        self.prefix: float = 0.0
+        self.context: float = 0.0
+        self.checks: float = 0.0
+        self.prepare: Optional[float] = None
+        self.callback: Optional[float] = None
+        self.send: float = 0.0
+
+    def lap(self) -> float:
+        """Returns the time since the previous lap."""
+
+        now = time.perf_counter()
+        elapsed, self.mark = now - self.mark, now
+        return elapsed
+
+
+class PipelineTimings:
+    """Per command histograms of each stage of the command pipeline.
+
+    Recording an invocation is one histogram observation per stage, and the memory
+    is bounded by the number of commands times the number of stages."""
+
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Dict[str, Histogram]] = {}
+        self.since: float = time.time()
+
+    def record(self, command: str, timing: CommandTiming) -> None:
+        total = time.perf_counter() - timing.started
+        if timing.prepare is None:
+            # The checks failed (or the command is on cooldown), the callback never ran
+            timing.prepare = timing.lap()
+
+        histograms = self.histograms.get(command)
+        if histograms is None:
+            histograms = self.histograms[command] = {stage: Histogram() for stage in STAGES}
+
+        histograms['prefix'].observe(timing.prefix)
+        histograms['context'].observe(timing.context)
+        histograms['checks'].observe(timing.checks)
+        histograms['prepare'].observe(timing.prepare)
+        if timing.callback is not None:
+            histograms['callback'].observe(max(timing.callback - timing.send, 0.0))
+            histograms['send'].observe(timing.send)
+        histograms['total'].observe(total)
+
+    def reset(self) -> None:
+        self.histograms.clear()
+        self.since = time.time()
+
+    def slowest(self, limit: int = 10) -> List[Tuple[str, Dict[str, Histogram]]]:
+        """Returns the commands with the highest p99 total latency first."""
+
+        return sorted(
+            self.histograms.items(), key=lambda item: item[1]['total'].percentile(99) or 0.0, reverse=True
+        )[:limit]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'since': self.since,
+            'commands': {
+                command: {stage: histogram.to_dict() for stage, histogram in histograms.items()}
+                for command, histograms in self.histograms.items()
+            },
+        }
+
+    def dump(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
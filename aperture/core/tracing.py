@@ -0,0 +1,255 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, Iterator, List, Optional
+
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextlib
+from contextvars import ContextVar
+
+
+__all__ = ('Span', 'Trace', 'Tracer', 'tracer')
+
+log = logging.getLogger(__name__)
+
+
+class Trace:
+    __slots__ = ('trace_id', 'tid', 'spans', 'finished', 'dropped')
+
+    def __init__(self, trace_id: str, tid: int) -> None:
+        self.trace_id: str = trace_id
+        # Chrome trace viewers require the spans of a thread to nest, each trace gets its own "thread"
+        self.tid: int = tid
+        self.spans: List[Span] = []
+        self.finished: bool = False
+        self.dropped: bool = False
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'args', 'start', 'end')
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], args: Dict[str, Any]) -> None:
+        self.trace: Trace = trace
+        self.span_id: str = f'{random.getrandbits(64):016x}'
+        self.parent_id: Optional[str] = parent_id
+        self.name: str = name
+        self.args: Dict[str, Any] = args
+        self.start: float = time.perf_counter()
+        self.end: Optional[float] = None
+
+    def to_event(self, pid: int) -> Dict[str, Any]:
+        """Returns the span as a complete event of the Chrome trace event format."""
+
+        args = {'trace_id': self.trace.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id}
+        args.update(self.args)
+        return {
+            'name': self.name,
+            'cat': 'aperture',
+            'ph': 'X',
+            'ts': self.start * 1e6,
+            'dur': ((self.end or self.start) - self.start) * 1e6,
+            'pid': pid,
+            'tid': self.trace.tid,
+            'args': args,
+        }
+
+
+class Tracer:
+    """Samples traces of the command pipeline and writes their spans to a file.
+
+    The current span is held in a context variable, so it follows the awaits of the task and the tasks created
+    from it. Spans outside of a sampled trace cost a context variable lookup. The file uses the Chrome trace
+    event format (JSON array of complete events, the closing bracket being optional), which can be opened in
+    Perfetto, chrome://tracing or speedscope. Spans are written by a worker thread, in batches of ``batch_size``
+    or every ``flush_interval`` seconds once :meth:`start` is called, whichever comes first.
+    """
+
+    def __init__(self) -> None:
+        self.sample_rate: float = 0.0
+        self.path: Optional[str] = None
+        self.batch_size: int = 256
+        self.flush_interval: float = 5.0
+        self.pid: int = os.getpid()
+
+        self._current: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+        self._next_tid: int = 0
+        self._pending: List[Dict[str, Any]] = []
+        self._file_lock = threading.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None and self.sample_rate > 0
+
+    def configure(
+        self,
+        path: Optional[str],
+        sample_rate: float,
+        *,
+        batch_size: int = 256,
+        flush_interval: float = 5.0,
+        worker_id: Optional[int] = None
+    ) -> None:
+        """Every process writes its own file, ``path`` is suffixed with ``worker_id`` (or the pid if not given),
+        e.g. ``traces.json`` becomes ``traces.worker-2.json``."""
+
+        self.pid = os.getpid()
+        if path is not None:
+            root, ext = os.path.splitext(path)
+            suffix = f'worker-{worker_id}' if worker_id is not None else f'pid-{self.pid}'
+            path = f'{root}.{suffix}{ext}'
+
+        self.path = path
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if self.enabled:
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write('[\n')
+            except OSError as e:
+                # Tracing is optional, it must not keep the bot from starting
+                log.error('Failed to open the trace file %s, tracing is disabled', path, exc_info=e)
+                self.path = None
+                return
+            log.info('Tracing %.2f%% of the commands into %s', sample_rate * 100, path)
+
+    @property
+    def current_span(self) -> Optional[Span]:
+        return self._current.get()
+
+    def current_trace_id(self) -> Optional[str]:
+        span = self._current.get()
+        return span.trace.trace_id if span is not None else None
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **args: Any) -> Iterator[Optional[Span]]:
+        """Starts a trace if this one is sampled, yielding its root span (or ``None``)."""
+
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield None
+            return
+
+        self._next_tid += 1
+        trace = Trace(f'{random.getrandbits(64):016x}', self._next_tid)
+        try:
+            with self._span(trace, name, None, args) as span:
+                yield span
+        finally:
+            trace.finished = True
+            if not trace.dropped:
+                self._export(trace.spans)
+            trace.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, *, parent: Optional[Span] = None, **args: Any) -> Iterator[Optional[Span]]:
+        """Records a child span of ``parent`` (by default the current span), if it's part of a sampled trace."""
+
+        parent = parent if parent is not None else self._current.get()
+        if parent is None:
+            yield None
+            return
+
+        with self._span(parent.trace, name, parent.span_id, args) as span:
+            yield span
+
+    def drop(self) -> None:
+        """Don't write the current trace (e.g. the message wasn't a command)."""
+
+        span = self._current.get()
+        if span is not None:
+            span.trace.dropped = True
+
+    @contextlib.contextmanager
+    def _span(self, trace: Trace, name: str, parent_id: Optional[str], args: Dict[str, Any]) -> Iterator[Span]:
+        span = Span(trace, name, parent_id, args)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.args['error'] = type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            self._current.reset(token)
+            if trace.finished:
+                # Ended after its trace (e.g. a queued webhook send)
+                if not trace.dropped:
+                    self._export([span])
+            else:
+                trace.spans.append(span)
+
+    def _export(self, spans: List[Span]) -> None:
+        self._pending.extend(span.to_event(self.pid) for span in spans)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def start(self) -> None:
+        """Starts flushing the pending spans every ``flush_interval`` seconds. Must be called from the running loop."""
+
+        if self.enabled and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        """Stops the periodic flush and writes the pending spans, waiting for the write to finish."""
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        future = self.flush()
+        if future is not None:
+            await future
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self) -> Optional[asyncio.Future]:
+        """Writes the pending spans in a worker thread, returning the future of the write
+        (or ``None`` if there was nothing to write or no running loop, in which case it is written inline)."""
+
+        if not self._pending or self.path is None:
+            return None
+
+        events, self._pending = self._pending, []
+        try:
+            return asyncio.get_running_loop().run_in_executor(None, self._write, events)
+        except RuntimeError:
+            self._write(events)
+            return None
+
+    def _write(self, events: List[Dict[str, Any]]) -> None:
+        data = ''.join(json.dumps(event, default=str) + ',\n' for event in events)
+        with self._file_lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(data)
+            except OSError as e:
+                log.error('Failed to write %s trace events', len(events), exc_info=e)
+
+
+tracer = Tracer()
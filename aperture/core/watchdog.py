@@ -0,0 +1,149 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Tuple
+
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+
+from .histogram import Histogram
+
+
+__all__ = ('LoopWatchdog', )
+
+log = logging.getLogger(__name__)
+
+# (filename, lineno, function) from the innermost frame outwards
+StackKey = Tuple[Tuple[str, int, str], ...]
+
+
+class LoopWatchdog:
+    """Measures the event loop lag and finds out what blocks the loop.
+
+    A task sleeps ``interval`` seconds in a loop and records how late it wakes up. A helper thread checks the
+    time of the last wake up, and once the loop is more than ``threshold`` seconds late it samples the stack
+    of the loop's thread every ``sample_interval`` seconds until the loop runs again. The innermost ``depth``
+    frames of each sample are counted, the most frequent stacks being the culprits.
+    """
+
+    def __init__(
+        self,
+        *,
+        interval: float = 0.1,
+        threshold: float = 0.25,
+        sample_interval: float = 0.01,
+        depth: int = 12,
+        max_culprits: int = 200
+    ) -> None:
+        self.interval: float = interval
+        self.threshold: float = threshold
+        self.sample_interval: float = sample_interval
+        self.depth: int = depth
+        self.max_culprits: int = max_culprits
+
+        self.lag: Histogram = Histogram()
+        self.stalls: int = 0
+        self.samples: int = 0
+        self.culprits: Counter[StackKey] = Counter()
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_beat: float = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Starts watching the running loop. Must be called from the loop's thread."""
+
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='aperture-loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def reset(self) -> None:
+        with self._lock:
+            self.lag = Histogram()
+            self.stalls = self.samples = 0
+            self.culprits.clear()
+
+    async def _beat(self) -> None:
+        while True:
+            start = time.monotonic()
+            self._last_beat = start
+            await asyncio.sleep(self.interval)
+            self.lag.observe(max(time.monotonic() - start - self.interval, 0.0))
+
+    def _watch(self) -> None:
+        stalled = False
+        while not self._stop.wait(self.sample_interval if stalled else self.interval / 2):
+            if time.monotonic() - self._last_beat - self.interval < self.threshold:
+                stalled = False
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=self.depth, lookup_lines=False)
+            key: StackKey = tuple((entry.filename, entry.lineno, entry.name) for entry in stack)
+            del frame
+
+            with self._lock:
+                if not stalled:
+                    self.stalls += 1
+                    stalled = True
+                self.samples += 1
+                self.culprits[key] += 1
+                if len(self.culprits) > self.max_culprits:
+                    # Forget the rarest stacks
+                    self.culprits = Counter(dict(self.culprits.most_common(self.max_culprits // 2)))
+
+            if self.samples % 100 == 1:
+                log.warning('Event loop blocked for more than %ss in %s:%s (%s)', self.threshold, *key[0][:2], key[0][2])
+
+    def top_culprits(self, limit: int = 10) -> List[Tuple[int, List[str]]]:
+        """Returns the most sampled blocking stacks, formatted innermost frame first."""
+
+        with self._lock:
+            top = self.culprits.most_common(limit)
+        return [(count, [f'{filename}:{lineno} in {name}' for filename, lineno, name in key]) for key, count in top]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'lag': self.lag.to_dict(),
+            'stalls': self.stalls,
+            'samples': self.samples,
+            'culprits': len(self.culprits),
+        }
@@ -0,0 +1,34 @@
+from __future__ import annotations
+from typing import Tuple, TYPE_CHECKING
+
+from discord.ext import commands
+
+from .database import QueryReport
+from .profiler import ProfileReport
+from .timings import PipelineReport
+from .usage import UsageReport
+from .watchdog import LagReport
+
+if TYPE_CHECKING:
+    from aperture import ApertureBot
+    from aperture.core import ApertureContext
+
+class Owner(commands.Cog):
+    """Commands for inspecting the bot, only usable by the bot owners"""
+
+    def __init__(self, bot: ApertureBot) -> None:
+        self.bot = bot
+
+        self.__cog_commands__: Tuple[commands.Command] = (
+            QueryReport(bot).command,
+            PipelineReport(bot).command,
+            LagReport(bot).command,
+            ProfileReport(bot).command,
+            UsageReport(bot).command,
+        )
+
+    async def cog_check(self, ctx: ApertureContext) -> bool:
+        return await self.bot.is_owner(ctx.author)
+
+def setup(bot: ApertureBot) -> None:
+    bot.add_cog(Owner(bot))
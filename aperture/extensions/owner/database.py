@@ -0,0 +1,74 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import List, TYPE_CHECKING
+
+import io
+
+import discord
+from discord.ext import commands
+
+from aperture.core import ApertureContext
+from aperture.core.types import CommandKwargsPayload
+
+if TYPE_CHECKING:
+    from aperture import ApertureBot
+
+
+class QueryReport:
+    def __init__(self, bot: ApertureBot) -> None:
+        self.bot = bot
+
+        kwargs = self._prepare_command()
+        self.command = commands.Command(self.callback, **kwargs)
+
+    def _prepare_command(self) -> CommandKwargsPayload:
+        kwargs: CommandKwargsPayload = {
+            'name': 'queries',
+            'aliases': ['querystats'],
+            'brief': 'Show the slowest database queries',
+            'description': 'Shows the database queries with the highest total execution time since the bot started.',
+            'help': """`limit`: The number of queries to show (default 10).""",
+            'usage': '[limit: int]',
+            'hidden': True,
+        }
+        return kwargs
+
+    async def callback(self, _: commands.Cog, ctx: ApertureContext, limit: int = 10) -> None:
+        top = self.bot.database.top_queries(max(1, limit))
+        if not top:
+            return await ctx.reply('No queries have been recorded yet')
+
+        lines: List[str] = [
+            f'{"#":>2} {"fingerprint":<12} {"calls":>7} {"total":>9} {"mean":>8} {"p99":>8} {"errors":>6}  query'
+        ]
+        for i, stats in enumerate(top, start=1):
+            latency = stats.latency
+            p99 = latency.percentile(99) or 0.0
+            lines.append(
+                f'{i:>2} {stats.fingerprint:<12} {latency.count:>7} {latency.sum * 1000:>7.0f}ms '
+                f'{latency.mean * 1000:>6.1f}ms {p99 * 1000:>6.1f}ms {stats.errors:>6}  {stats.query}'
+            )
+
+        table = '\n'.join(lines)
+        if len(table) > 1900:
+            file = discord.File(io.BytesIO(table.encode('utf-8')), filename='queries.txt')
+            return await ctx.reply(f'Top {len(top)} queries by total time', file=file)
+
+        return await ctx.reply(f'```\n{table}```')
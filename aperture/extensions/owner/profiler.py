@@ -0,0 +1,83 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import List, TYPE_CHECKING
+
+import io
+import asyncio
+
+import discord
+from discord.ext import commands
+
+from aperture.core import ApertureContext
+from aperture.core.profiler import SamplingProfiler
+from aperture.core.types import CommandKwargsPayload
+
+if TYPE_CHECKING:
+    from aperture import ApertureBot
+
+
+class ProfileReport:
+    def __init__(self, bot: ApertureBot) -> None:
+        self.bot = bot
+        self.lock = asyncio.Lock()
+
+        kwargs = self._prepare_command()
+        self.command = commands.Command(self.callback, **kwargs)
+
+    def _prepare_command(self) -> CommandKwargsPayload:
+        kwargs: CommandKwargsPayload = {
+            'name': 'profile',
+            'aliases': ['flamegraph'],
+            'brief': 'Profile the running bot',
+            'description': 'Samples the stacks of every thread for a few seconds and uploads them as collapsed stacks '
+                           '(open them in speedscope or feed them to flamegraph.pl).',
+            'help': """`seconds`: How long to sample for, 1 to 120 (default 10).\n"""
+                    """`memory`: Also diff the allocations with tracemalloc, this slows the bot down noticeably (default no).""",
+            'usage': '[seconds: float] [memory: bool]',
+            'hidden': True,
+        }
+        return kwargs
+
+    async def callback(self, _: commands.Cog, ctx: ApertureContext, seconds: float = 10.0, memory: bool = False) -> None:
+        if self.lock.locked():
+            return await ctx.reply('A profile is already running... Please wait for it to finish')
+
+        seconds = min(max(seconds, 1.0), 120.0)
+        async with self.lock:
+            await ctx.reply(f'Profiling for {seconds:g} seconds{" with allocation tracing" if memory else ""}...')
+
+            profiler = SamplingProfiler()
+            # The sampler blocks its own thread, the loop keeps running (and gets profiled)
+            await self.bot.loop.run_in_executor(None, lambda: profiler.run(seconds, memory=memory))
+
+        files: List[discord.File] = [
+            discord.File(io.BytesIO(profiler.collapsed().encode('utf-8')), filename='profile.collapsed')
+        ]
+        if profiler.memory_diff is not None:
+            files.append(discord.File(io.BytesIO('\n'.join(profiler.memory_diff).encode('utf-8')), filename='allocations.txt'))
+
+        lines: List[str] = [f'{profiler.samples} samples over {profiler.elapsed:.1f}s, most sampled functions:']
+        for function, count in profiler.top_functions(8):
+            lines.append(f'{count:>6}  {function[:150]}')
+        summary = '\n'.join(lines)
+        if len(summary) > 1900:
+            summary = summary[:1900]
+
+        return await ctx.reply(f'```\n{summary}```', files=files)
@@ -0,0 +1,99 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import List, Optional, TYPE_CHECKING
+
+import io
+import os
+
+import discord
+from discord.ext import commands
+
+from aperture.core import ApertureContext
+from aperture.core.timings import STAGES
+from aperture.core.types import CommandKwargsPayload
+
+if TYPE_CHECKING:
+    from aperture import ApertureBot
+
+
+class PipelineReport:
+    def __init__(self, bot: ApertureBot) -> None:
+        self.bot = bot
+        self.dump_path: str = os.getenv('COMMAND_TIMINGS_DUMP_PATH', './tmp/command_timings.json')
+
+        kwargs = self._prepare_command()
+        self.command = commands.Command(self.callback, **kwargs)
+
+    def _prepare_command(self) -> CommandKwargsPayload:
+        kwargs: CommandKwargsPayload = {
+            'name': 'timings',
+            'aliases': ['pipeline'],
+            'brief': 'Show where the time of the commands goes',
+            'description': 'Shows the p50/p99 latency of each stage of the command pipeline, per command.',
+            'help': """`action`: `on` or `off` to start or stop recording, `reset` to clear the recorded timings, """
+                    """`dump` to write them to a file, or a command name to only show that command (default: every command).""",
+            'usage': '[action: str]',
+            'hidden': True,
+        }
+        return kwargs
+
+    async def callback(self, _: commands.Cog, ctx: ApertureContext, action: Optional[str] = None) -> None:
+        if action == 'on':
+            self.bot.enable_timings()
+            return await ctx.reply('Recording the command pipeline timings')
+        if action == 'off':
+            self.bot.disable_timings()
+            return await ctx.reply('Stopped recording the command pipeline timings')
+
+        timings = self.bot.pipeline_timings
+        if timings is None:
+            return await ctx.reply('The command pipeline timings are not being recorded, use `timings on` first')
+
+        if action == 'reset':
+            timings.reset()
+            return await ctx.reply('Cleared the recorded timings')
+        if action == 'dump':
+            await self.bot.loop.run_in_executor(None, timings.dump, self.dump_path)
+            return await ctx.reply(f'Dumped the recorded timings to `{self.dump_path}`')
+
+        if action is not None:
+            histograms = timings.histograms.get(action)
+            rows = [(action, histograms)] if histograms is not None else []
+        else:
+            rows = timings.slowest(15)
+        if not rows:
+            return await ctx.reply('No timings have been recorded yet')
+
+        lines: List[str] = [f'{"command":<16} {"calls":>6}  ' + ' '.join(f'{stage:>15}' for stage in STAGES)]
+        for command, histograms in rows:
+            cells = []
+            for stage in STAGES:
+                histogram = histograms[stage]
+                p50, p99 = (histogram.percentile(50) or 0.0) * 1000, (histogram.percentile(99) or 0.0) * 1000
+                cells.append(f'{p50:>6.1f}/{p99:>6.1f}ms')
+            lines.append(f'{command[:16]:<16} {histograms["total"].count:>6}  ' + ' '.join(cells))
+
+        table = '\n'.join(lines)
+        header = 'p50/p99 per stage of the command pipeline'
+        if len(table) > 1900:
+            file = discord.File(io.BytesIO(table.encode('utf-8')), filename='timings.txt')
+            return await ctx.reply(header, file=file)
+
+        return await ctx.reply(f'{header}\n```\n{table}```')
@@ -0,0 +1,66 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import List, Optional, TYPE_CHECKING
+
+import datetime
+
+from discord.ext import commands
+
+from aperture.core import ApertureContext
+from aperture.core.types import CommandKwargsPayload
+
+if TYPE_CHECKING:
+    from aperture import ApertureBot
+
+
+class UsageReport:
+    def __init__(self, bot: ApertureBot) -> None:
+        self.bot = bot
+
+        kwargs = self._prepare_command()
+        self.command = commands.Command(self.callback, **kwargs)
+
+    def _prepare_command(self) -> CommandKwargsPayload:
+        kwargs: CommandKwargsPayload = {
+            'name': 'usage',
+            'aliases': ['topcommands'],
+            'brief': 'Show the most used commands',
+            'description': 'Shows the most used commands, read from the hourly command usage rollups.',
+            'help': """`hours`: How far back to count the usage (default: 24).\n"""
+                    """`scope`: `here` to only count the usage in this guild (default: every guild).""",
+            'usage': '[hours: int] [scope: str]',
+            'hidden': True,
+        }
+        return kwargs
+
+    async def callback(self, _: commands.Cog, ctx: ApertureContext, hours: int = 24, scope: Optional[str] = None) -> None:
+        if hours < 1:
+            return await ctx.reply('`hours` must be at least 1')
+
+        guild = ctx.guild if scope == 'here' else None
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours)
+        rows = await self.bot.cache.command_usage.top_commands(since, guild=guild, limit=15)
+        if not rows:
+            return await ctx.reply('No command usage has been recorded in that time')
+
+        width = max(len(name) for name, _ in rows)
+        lines: List[str] = [f'{name:<{width}} {uses:>8}' for name, uses in rows]
+        where = f'in {guild}' if guild is not None else 'in every guild'
+        return await ctx.reply(f'Most used commands of the last {hours}h {where}\n```\n' + '\n'.join(lines) + '```')
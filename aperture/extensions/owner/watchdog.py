@@ -0,0 +1,78 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import List, Optional, TYPE_CHECKING
+
+import io
+
+import discord
+from discord.ext import commands
+
+from aperture.core import ApertureContext
+from aperture.core.types import CommandKwargsPayload
+
+if TYPE_CHECKING:
+    from aperture import ApertureBot
+
+
+class LagReport:
+    def __init__(self, bot: ApertureBot) -> None:
+        self.bot = bot
+
+        kwargs = self._prepare_command()
+        self.command = commands.Command(self.callback, **kwargs)
+
+    def _prepare_command(self) -> CommandKwargsPayload:
+        kwargs: CommandKwargsPayload = {
+            'name': 'lag',
+            'aliases': ['blocking'],
+            'brief': 'Show what blocks the event loop',
+            'description': 'Shows the event loop lag and the stacks sampled while the loop was blocked.',
+            'help': """`action`: `reset` to clear the recorded lag and stacks (default: show them).""",
+            'usage': '[action: str]',
+            'hidden': True,
+        }
+        return kwargs
+
+    async def callback(self, _: commands.Cog, ctx: ApertureContext, action: Optional[str] = None) -> None:
+        watchdog = self.bot.watchdog
+        if watchdog is None:
+            return await ctx.reply('The event loop watchdog is disabled (`LOOP_LAG_THRESHOLD` is 0)')
+
+        if action == 'reset':
+            watchdog.reset()
+            return await ctx.reply('Cleared the recorded lag and stacks')
+
+        lag = watchdog.lag
+        lines: List[str] = [
+            f'Lag: p50 {(lag.percentile(50) or 0.0) * 1000:.1f}ms, p99 {(lag.percentile(99) or 0.0) * 1000:.1f}ms, '
+            f'max {lag.max * 1000:.1f}ms over {lag.count} checks',
+            f'Blocked above {watchdog.threshold * 1000:.0f}ms: {watchdog.stalls} times, {watchdog.samples} stack samples',
+        ]
+        for count, stack in watchdog.top_culprits(10):
+            lines.append('')
+            lines.append(f'{count} samples ({count * watchdog.sample_interval * 1000:.0f}ms):')
+            lines.extend(f'  {frame}' for frame in stack)
+
+        report = '\n'.join(lines)
+        if len(report) > 1900:
+            file = discord.File(io.BytesIO(report.encode('utf-8')), filename='lag.txt')
+            return await ctx.reply('Event loop lag report', file=file)
+
+        return await ctx.reply(f'```\n{report}```')
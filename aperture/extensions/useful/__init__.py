@@ -13,10 +13,14 @@ class Useful(commands.Cog):
 
     def __init__(self, bot: ApertureBot) -> None:
         self.bot = bot
+        self.snekbox = Snekbox(bot)
 
         self.__cog_commands__: Tuple[commands.Command] = (
-            Snekbox(bot).command,
+            self.snekbox.command,
         )
 
+    def cog_unload(self) -> None:
+        self.bot.loop.create_task(self.snekbox.close())
+
 def setup(bot: ApertureBot) -> None:
     bot.add_cog(Useful(bot))
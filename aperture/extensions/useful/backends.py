@@ -0,0 +1,275 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import re
+import json
+import time
+import asyncio
+import aiohttp
+import logging
+
+from aperture.core.error import ApertureError
+from aperture.core.histogram import Histogram
+from aperture.core.tracing import tracer
+
+
+log = logging.getLogger(__name__)
+
+STDOUT_REGEX = re.compile(rb'"stdout"\s*:\s*"')
+RETURNCODE_REGEX = re.compile(rb'"returncode"\s*:\s*(-?\d+|null)')
+# A trailing backslash escape which got cut in the middle
+PARTIAL_ESCAPE_REGEX = re.compile(r'(?<!\\)(\\\\)*\\(u[0-9a-fA-F]{0,3})?$')
+
+
+def salvage_result(body: bytes) -> Dict[str, Any]:
+    """Recovers the stdout (and the returncode if it was sent first) from a truncated snekbox response."""
+
+    result: Dict[str, Any] = {'stdout': '', 'returncode': None}
+    if (match := RETURNCODE_REGEX.search(body)) is not None and match.group(1) != b'null':
+        result['returncode'] = int(match.group(1))
+
+    if (match := STDOUT_REGEX.search(body)) is not None:
+        raw = body[match.end():].decode('utf-8', 'ignore')
+        if (end := PARTIAL_ESCAPE_REGEX.search(raw)) is not None:
+            raw = raw[:end.start() + len(end.group(1) or '')]
+        try:
+            result['stdout'], _ = json.decoder.scanstring(raw + '"', 0)
+        except ValueError:
+            pass
+    return result
+
+
+class NoSnekboxBackend(ApertureError):
+    """None of the snekbox backends could evaluate the job"""
+
+    def __init__(self, last_error: Optional[BaseException] = None, *args: Any) -> None:
+        self.last_error: Optional[BaseException] = last_error
+        super().__init__(f'No snekbox backend is available (last error: {last_error!r})', *args)
+
+
+class BackendFailure(Exception):
+    """The backend answered with a server error"""
+
+
+class SnekboxBackend:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    __slots__ = ('url', 'outstanding', 'healthy', 'state', 'failures', 'opened_at', 'trial_in_flight',
+                 'requests', 'errors', 'latency')
+
+    def __init__(self, url: str) -> None:
+        self.url: str = url
+        self.outstanding: int = 0
+        self.healthy: bool = True
+
+        # Circuit breaker
+        self.state: str = self.CLOSED
+        self.failures: int = 0
+        self.opened_at: float = 0.0
+        self.trial_in_flight: bool = False
+
+        self.requests: int = 0
+        self.errors: int = 0
+        self.latency: Histogram = Histogram()
+
+    def available(self, now: float, cooldown: float) -> bool:
+        if self.state == self.OPEN and now - self.opened_at >= cooldown:
+            # Let a single trial request through to find out whether the backend recovered
+            self.state = self.HALF_OPEN
+        if not self.healthy or self.state == self.OPEN:
+            return False
+        if self.state == self.HALF_OPEN:
+            return not self.trial_in_flight
+        return True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            log.info('Snekbox backend %s recovered, closing its circuit', self.url)
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self, threshold: int) -> None:
+        self.errors += 1
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            log.warning('Ejected snekbox backend %s after %s consecutive failures', self.url, self.failures)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'state': self.state,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency': self.latency.to_dict(),
+        }
+
+
+class SnekboxBackends:
+    """Balances eval jobs over several snekbox servers.
+
+    Every job goes to the available backend with the least outstanding requests. A backend failing
+    ``failure_threshold`` times in a row (connection errors, timeouts or 5xx responses) gets its circuit
+    opened and receives no job for ``cooldown`` seconds, after which a single trial job decides whether
+    it's put back. Failed jobs are retried on another backend. Backends are also probed every
+    ``probe_interval`` seconds, and the ones not responding are skipped until they respond again.
+    """
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        *,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        probe_interval: float = 10.0,
+        probe_timeout: float = 5.0,
+        timeout: float = 30.0,
+        max_bytes: int = 1024 * 1024
+    ) -> None:
+        self.backends: List[SnekboxBackend] = [SnekboxBackend(url) for url in urls]
+        self.failure_threshold: int = failure_threshold
+        self.cooldown: float = cooldown
+        self.probe_interval: float = probe_interval
+        self.probe_timeout: float = probe_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 5.0))
+        self.max_bytes: int = max_bytes
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_urls(cls, urls: Optional[str], **kwargs: Any) -> SnekboxBackends:
+        """Creates the backends from a comma separated list of URLs. Without any URL,
+        every job fails with :class:`NoSnekboxBackend`."""
+
+        return cls([url.strip() for url in (urls or '').split(',') if url.strip()], **kwargs)
+
+    def pick(self, exclude: Set[SnekboxBackend]) -> Optional[SnekboxBackend]:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now, self.cooldown)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.outstanding)
+
+    async def post(self, session: aiohttp.ClientSession, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Sends the job to a backend, retrying on the other ones if it fails.
+        Returns the HTTP status and the JSON body of the response.
+
+        At most ``max_bytes`` of the body are read, past that the stdout is truncated
+        and the result gets a ``truncated`` key set to ``True``."""
+
+        self._start_probing(session)
+
+        tried: Set[SnekboxBackend] = set()
+        last_error: Optional[BaseException] = None
+        while (backend := self.pick(tried)) is not None:
+            tried.add(backend)
+            trial = backend.state == SnekboxBackend.HALF_OPEN
+            backend.trial_in_flight = trial
+            backend.outstanding += 1
+            backend.requests += 1
+            start = time.perf_counter()
+            try:
+                with tracer.span('snekbox.post', url=backend.url) as span:
+                    async with session.post(backend.url, json=payload, timeout=self.timeout) as response:
+                        if span is not None:
+                            span.args['status'] = response.status
+                        if response.status >= 500:
+                            raise BackendFailure(f'HTTP Status code {response.status}')
+                        result = await self._read(response)
+                        status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError, BackendFailure) as e:
+                backend.record_failure(self.failure_threshold)
+                last_error = e
+                log.warning('Snekbox backend %s failed: %r', backend.url, e)
+                continue
+            finally:
+                backend.outstanding -= 1
+                if trial:
+                    backend.trial_in_flight = False
+                backend.latency.observe(time.perf_counter() - start)
+
+            backend.record_success()
+            return status, result
+
+        raise NoSnekboxBackend(last_error)
+
+    async def _read(self, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            if len(body) + len(chunk) > self.max_bytes:
+                body += chunk[:self.max_bytes - len(body)]
+                # Don't bother reading (or keeping the connection for) the rest
+                response.close()
+                result = salvage_result(bytes(body))
+                result['truncated'] = True
+                return result
+            body += chunk
+
+        try:
+            result = json.loads(body)
+        except ValueError:
+            result = None
+        if response.status == 200 and not (isinstance(result, dict) and 'stdout' in result and 'returncode' in result):
+            # Counted as a failure of the backend, and retried on another one
+            raise BackendFailure('Malformed eval response')
+        # Only the status of the other responses is used
+        return result if isinstance(result, dict) else {}
+
+    def _start_probing(self, session: aiohttp.ClientSession) -> None:
+        self._session = session
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def _probe(self, backend: SnekboxBackend) -> None:
+        try:
+            timeout = aiohttp.ClientTimeout(total=self.probe_timeout)
+            # Any non-5xx answer (even 405 for a GET on the eval endpoint) means the server is up
+            async with self._session.get(backend.url, timeout=timeout) as response:
+                healthy = response.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+
+        if healthy != backend.healthy:
+            log.info('Snekbox backend %s is now %s', backend.url, 'healthy' if healthy else 'unhealthy')
+        backend.healthy = healthy
+
+    async def _probe_loop(self) -> None:
+        while self._session is not None and not self._session.closed:
+            await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+            await asyncio.sleep(self.probe_interval)
+
+    async def close(self) -> None:
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [backend.stats() for backend in self.backends]
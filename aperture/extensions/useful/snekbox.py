@@ -17,25 +17,35 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import TYPE_CHECKING, Set, Tuple
+from typing import TYPE_CHECKING, Any, Deque, Dict, Iterator, Optional, Set, Tuple
 
 import os
 import re
 import io
-import aiohttp
+import ast
+import gzip
+import time
+import hashlib
+import asyncio
 import logging
-import contextlib
 import traceback
 import textwrap
 import signal
+from collections import OrderedDict, deque
 
 import discord
 from discord.ext import commands
 from aperture.core.cooldown import ApertureCooldown
 
 from aperture.core import ApertureContext, ApertureEmoji
+from aperture.core.error import ApertureError
+from aperture.core.histogram import Histogram
+from aperture.core.metrics import Counter, Gauge, HistogramMetric, Metric
+from aperture.core.tracing import tracer
 from aperture.core.types import CommandKwargsPayload
 
+from .backends import NoSnekboxBackend, SnekboxBackends
+
 if TYPE_CHECKING:
     from aperture import ApertureBot
 
@@ -63,6 +73,287 @@ RAW_CODE_REGEX = re.compile(
 ESCAPE_REGEX = re.compile("[`\u202E\u200B]{3,}")
 
 
+# Modules whose usage makes the output differ between runs
+NONDETERMINISTIC_MODULES = frozenset({
+    'random', 'secrets', 'time', 'datetime', 'uuid', 'os', 'sys', 'platform', 'socket', 'threading',
+    'multiprocessing', 'subprocess', 'tempfile', 'importlib', 'asyncio', 'gc', 'resource', 'zoneinfo', 'calendar',
+})
+# Builtins whose result depends on the process (addresses, hash seeds, the order of sets) or which can import anything
+NONDETERMINISTIC_BUILTINS = frozenset({
+    'id', 'hash', 'input', 'open', 'exec', 'eval', 'compile', '__import__', 'set', 'frozenset',
+    'object', 'dir', 'vars', 'globals', 'locals',
+})
+# Memory addresses, as printed by the default repr of objects, functions, lambdas and classes
+ADDRESS_REGEX = re.compile(r"0x[0-9a-f]+", re.IGNORECASE)
+
+
+def is_deterministic(code: str) -> bool:
+    """Conservatively tells whether running ``code`` twice prints the same output."""
+
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        # The SyntaxError printed by the server is deterministic too
+        return True
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            if any(alias.name.split('.')[0] in NONDETERMINISTIC_MODULES for alias in node.names):
+                return False
+        elif isinstance(node, ast.ImportFrom):
+            if node.module is not None and node.module.split('.')[0] in NONDETERMINISTIC_MODULES:
+                return False
+        elif isinstance(node, ast.Name):
+            if node.id in NONDETERMINISTIC_BUILTINS:
+                return False
+        elif isinstance(node, (ast.Set, ast.SetComp)):
+            # The iteration order of a set of strings depends on the hash seed
+            return False
+    return True
+
+
+class SnekboxResultCache:
+    """LRU cache of snekbox results keyed by the hash of the normalized code, bounded by the bytes it stores.
+
+    Entries expire after ``ttl`` seconds. Code which may print a different output on every run (judging by
+    the code, and by memory addresses in the output) is not cached, unless ``allow_nondeterministic`` is set.
+    """
+
+    # Rough per entry overhead of the key, the dict and the bookkeeping
+    ENTRY_OVERHEAD: int = 256
+
+    def __init__(self, *, max_bytes: int, ttl: float = 3600.0, allow_nondeterministic: bool = False) -> None:
+        self.max_bytes: int = max_bytes
+        self.ttl: float = ttl
+        self.allow_nondeterministic: bool = allow_nondeterministic
+
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.uncacheable: int = 0
+        # key -> (expires at, size, result)
+        self._entries: OrderedDict[str, Tuple[float, int, Dict[str, Any]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(code: str) -> str:
+        normalized = '\n'.join(line.rstrip() for line in code.strip('\n').splitlines())
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+
+        key = self.key(code)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, size, result = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.size -= size
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, code: str, result: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        # Signals other than SIGKILL (timeout/OOM) and NsJail errors may not happen on the next run
+        if result.get('returncode') is None or result['returncode'] >= 128:
+            return
+        stdout: str = result.get('stdout', '')
+        if not self.allow_nondeterministic and (not is_deterministic(code) or ADDRESS_REGEX.search(stdout)):
+            self.uncacheable += 1
+            return
+
+        size = len(stdout.encode('utf-8')) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+
+        key = self.key(code)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+        self._entries[key] = (time.monotonic() + self.ttl, size, result)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'uncacheable': self.uncacheable,
+        }
+
+
+class SnekboxOverloaded(ApertureError):
+    """The snekbox job queue is full"""
+
+    def __init__(self, depth: int, *args: Any) -> None:
+        self.depth: int = depth
+        super().__init__(f'The snekbox job queue is full ({depth} jobs waiting)', *args)
+
+
+class SnekboxJob:
+    __slots__ = ('user_id', 'guild_id', 'premium', 'enqueued_at', 'started_at', 'future')
+
+    def __init__(self, user_id: int, guild_id: int, premium: bool) -> None:
+        self.user_id: int = user_id
+        self.guild_id: int = guild_id
+        self.premium: bool = premium
+        self.enqueued_at: float = time.perf_counter()
+        self.started_at: Optional[float] = None
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def started(self) -> bool:
+        return self.started_at is not None
+
+
+class SnekboxScheduler:
+    """Bounds the number of jobs running on the snekbox server at once, and queues the rest fairly.
+
+    Waiting jobs are grouped per guild (DMs are grouped per user) and guilds are served round-robin,
+    so a few busy guilds can't starve the others. Premium users/guilds have their own queue which is
+    served ``premium_weight`` times for every job of the normal queue. Jobs are rejected with
+    :exc:`SnekboxOverloaded` once ``max_queue`` jobs are waiting.
+    """
+
+    def __init__(self, *, max_concurrency: int = 4, max_queue: int = 50, premium_weight: int = 3) -> None:
+        self.max_concurrency: int = max_concurrency
+        self.max_queue: int = max_queue
+        self.premium_weight: int = premium_weight
+
+        self.running: int = 0
+        self.depth: int = 0
+        self.rejected: int = 0
+        # premium -> guild -> waiting jobs, in round-robin order of the guilds
+        self._queues: Dict[bool, OrderedDict[int, Deque[SnekboxJob]]] = {True: OrderedDict(), False: OrderedDict()}
+        self._premium_streak: int = 0
+
+        self.queue_wait: Histogram = Histogram()
+        self.execution_time: Histogram = Histogram()
+
+    def submit(self, user_id: int, guild_id: int, premium: bool) -> SnekboxJob:
+        job = SnekboxJob(user_id, guild_id, premium)
+        if self.running < self.max_concurrency and not self.depth:
+            self._start(job)
+            return job
+
+        if self.depth >= self.max_queue:
+            self.rejected += 1
+            raise SnekboxOverloaded(self.depth)
+
+        self._queues[premium].setdefault(guild_id, deque()).append(job)
+        self.depth += 1
+        return job
+
+    async def wait(self, job: SnekboxJob) -> None:
+        try:
+            await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if not job.started:
+                self._discard(job)
+            raise
+
+    def release(self, job: SnekboxJob) -> None:
+        if not job.started:
+            self._discard(job)
+            return
+
+        self.running -= 1
+        self.execution_time.observe(time.perf_counter() - job.started_at)
+        self._dispatch()
+
+    def position(self, job: SnekboxJob) -> int:
+        """The 1-based position of the job in the dispatch order, 0 if it is already running."""
+
+        if job.started:
+            return 0
+        for position, queued in enumerate(self._dispatch_order(), start=1):
+            if queued is job:
+                return position
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self.running,
+            'queued': self.depth,
+            'rejected': self.rejected,
+            'queue_wait': self.queue_wait.to_dict(),
+            'execution_time': self.execution_time.to_dict(),
+        }
+
+    def _start(self, job: SnekboxJob) -> None:
+        self.running += 1
+        job.started_at = time.perf_counter()
+        self.queue_wait.observe(job.started_at - job.enqueued_at)
+        job.future.set_result(None)
+
+    def _discard(self, job: SnekboxJob) -> None:
+        queue = self._queues[job.premium]
+        jobs = queue.get(job.guild_id)
+        if jobs is None or job not in jobs:
+            return
+        jobs.remove(job)
+        if not jobs:
+            del queue[job.guild_id]
+        self.depth -= 1
+
+    def _pick_premium(self, premium_streak: int, has_premium: bool, has_normal: bool) -> bool:
+        return has_premium and (not has_normal or premium_streak < self.premium_weight)
+
+    def _dispatch(self) -> None:
+        while self.running < self.max_concurrency and self.depth:
+            premium = self._pick_premium(self._premium_streak, bool(self._queues[True]), bool(self._queues[False]))
+            self._premium_streak = self._premium_streak + 1 if premium else 0
+
+            queue = self._queues[premium]
+            guild_id, jobs = next(iter(queue.items()))
+            job = jobs.popleft()
+            if jobs:
+                queue.move_to_end(guild_id)
+            else:
+                del queue[guild_id]
+            self.depth -= 1
+            self._start(job)
+
+    def _dispatch_order(self) -> Iterator[SnekboxJob]:
+        # Same as _dispatch, on a copy of the queues
+        queues: Dict[bool, Deque[Deque[SnekboxJob]]] = {
+            premium: deque(deque(jobs) for jobs in queue.values()) for premium, queue in self._queues.items()
+        }
+        streak = self._premium_streak
+        while queues[True] or queues[False]:
+            premium = self._pick_premium(streak, bool(queues[True]), bool(queues[False]))
+            streak = streak + 1 if premium else 0
+
+            jobs = queues[premium].popleft()
+            yield jobs.popleft()
+            if jobs:
+                queues[premium].append(jobs)
+
+
 class Snekbox:
     def __init__(self, bot: ApertureBot) -> None:
         self.bot = bot
@@ -70,8 +361,31 @@ class Snekbox:
         kwargs = self._prepare_command()
         self.command = commands.Command(self.callback, **kwargs)
 
-        self.snekbox_url: str = os.getenv('SNEKBOX_URL')
+        # SNEKBOX_URLS takes a comma separated list of servers to balance the jobs over
+        self.backends = SnekboxBackends.from_urls(
+            os.getenv('SNEKBOX_URLS') or os.getenv('SNEKBOX_URL'),
+            failure_threshold=int(os.getenv('SNEKBOX_FAILURE_THRESHOLD', 3)),
+            cooldown=float(os.getenv('SNEKBOX_EJECT_COOLDOWN', 30)),
+            timeout=float(os.getenv('SNEKBOX_TIMEOUT', 30)),
+            max_bytes=int(os.getenv('SNEKBOX_MAX_OUTPUT_BYTES', 1024 * 1024)),
+        )
+        if not self.backends.backends:
+            log.warning('Neither SNEKBOX_URLS nor SNEKBOX_URL is set, eval jobs will fail')
+        # Attachments bigger than this are sent gzipped
+        self.compress_threshold: int = int(os.getenv('SNEKBOX_COMPRESS_THRESHOLD', 64 * 1024))
+
+        bot.metrics.add_collector(self._collect_metrics)
         self.running_jobs: Set[int] = set()
+        self.scheduler = SnekboxScheduler(
+            max_concurrency=int(os.getenv('SNEKBOX_MAX_CONCURRENCY', 4)),
+            max_queue=int(os.getenv('SNEKBOX_MAX_QUEUE', 50)),
+        )
+        # Disabled unless SNEKBOX_CACHE_MAX_BYTES is set
+        self.result_cache = SnekboxResultCache(
+            max_bytes=int(os.getenv('SNEKBOX_CACHE_MAX_BYTES', 0)),
+            ttl=float(os.getenv('SNEKBOX_CACHE_TTL', 3600)),
+            allow_nondeterministic=os.getenv('SNEKBOX_CACHE_NONDETERMINISTIC', 'false').lower() == 'true',
+        )
 
 
     def _prepare_command(self) -> CommandKwargsPayload:
@@ -123,7 +437,11 @@ class Snekbox:
         response = f'Your Evaluation job has completed and responded with Return Code `{returncode}`'
         error = ''
 
-        if returncode is None:
+        if returncode is None and result.get('truncated'):
+            # The return code comes after the output, it got cut off with it
+            response = 'Your eval job produced more output than can be shown'
+            return f'{ApertureEmoji.warning} ' + response, error
+        elif returncode is None:
             response = 'Your eval job has failed'
             error = stdout.strip()
         elif returncode == 128 + 9: # 128 + SIGKILL
@@ -138,7 +456,7 @@ class Snekbox:
             except ValueError:
                 pass
 
-        if not stdout.strip(): # No output
+        if not stdout or stdout.isspace(): # No output, checked without copying it
             response = f'{ApertureEmoji.warning} ' + response
         elif returncode == 0: # No error
             response = f'{ApertureEmoji.tick} ' + response
@@ -154,37 +472,56 @@ class Snekbox:
                 'You already have an eval job running... Please wait it to finish before starting another'
             )
 
-        log_msg = 'Snekbox server responded with HTTP Status code %s for '\
-            'Message ID: %s, Author ID: %s, Channel ID: %s, Guild ID: %s'
+        formatted_code = self.parse_codeblock(code)
+
+        # Identical code already evaluated, no need to launch a jail for it again
+        if (cached := self.result_cache.get(formatted_code)) is not None:
+            log.debug('Snekbox result cache hit for Message ID: %s', ctx.message.id)
+            return await self._send_result(ctx, cached)
+
+        premium = ctx.author.id in self.bot.cache.premium.users or (
+            ctx.guild is not None and ctx.guild.id in self.bot.cache.premium.guilds
+        )
+        try:
+            # DMs are queued per user
+            job = self.scheduler.submit(ctx.author.id, ctx.guild.id if ctx.guild is not None else ctx.author.id, premium)
+        except SnekboxOverloaded:
+            log.warning('Rejected eval job of Author ID: %s, snekbox queue is full', ctx.author.id)
+            return await ctx.reply('Too many eval jobs are waiting right now... Please try again after some time')
 
         self.running_jobs.add(ctx.author.id)
+        try:
+            if not job.started:
+                await ctx.reply(
+                    f'Your eval job is queued at position `{self.scheduler.position(job)}`, it\'ll start shortly'
+                )
+            with tracer.span('snekbox.queue', premium=premium):
+                await self.scheduler.wait(job)
 
-        formatted_code = self.parse_codeblock(code)
+            return await self._evaluate(ctx, formatted_code)
+        finally:
+            self.running_jobs.discard(ctx.author.id)
+            self.scheduler.release(job)
+
+    async def _evaluate(self, ctx: ApertureContext, formatted_code: str) -> None:
+        log_msg = 'Snekbox server responded with HTTP Status code %s for '\
+            'Message ID: %s, Author ID: %s, Channel ID: %s, Guild ID: %s'
 
         async with ctx.typing():
             payload = {'input': formatted_code}
             try:
-                response = await ctx.bot.http_session.post(self.snekbox_url, json=payload)
+                http_status, result = await self.backends.post(ctx.bot.http_session, payload)
                 log.debug('Code sent for evaluation to snekbox. Code: %s', formatted_code)
-            except aiohttp.ClientConnectorError as e:
-                with contextlib.suppress(KeyError):
-                    self.running_jobs.remove(ctx.author.id)
+            except NoSnekboxBackend as e:
                 await ctx.reply('Oops! Failed to connect to the server. Please try again after some time')
                 exc = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
                 await ctx.bot.webhook_client.send_critical_report(
                     ctx,
-                    f'Failed to connect to the Snekbox Server!\nException: ```{exc}```'
+                    f'No Snekbox Server is available!\nException: ```{exc}```'
                 )
-                log.error('Failed to connect to Snekbox')
+                log.error('No Snekbox server is available')
                 return
 
-            result = await response.json()
-
-            stdout, http_status = result['stdout'], response.status
-
-            with contextlib.suppress(KeyError):
-                self.running_jobs.remove(ctx.author.id)
-
             if http_status != 200:
                 if str(http_status)[0] in ['1', '2']:
                     log_method = log.debug
@@ -198,14 +535,53 @@ class Snekbox:
                     'Please try again after some time'
                 )
 
-            response, error = self.get_return_message(result)
-            content = error if error else stdout
-            output = response +  '\n\n' + '```\n' + '[No Output]' + '```' if not content else '\n\n' + '```py\n' + content + '```'
+            self.result_cache.put(formatted_code, result)
+            return await self._send_result(ctx, result)
 
-            if len(output.split('\n')) > 15 or len(output) > 1900: # Idk, Just in case, keep the max limit a bit less than 2000
-                buffer = io.StringIO(content)
-                buffer.seek(0)
-                file = discord.File(buffer, filename='output.txt')
-                return await ctx.send(response, file=file)
+    def _collect_metrics(self) -> Iterator[Metric]:
+        jobs = Gauge('aperture_snekbox_jobs', 'Eval jobs running or waiting for a slot', ('state', ))
+        jobs.set(self.scheduler.running, 'running')
+        jobs.set(self.scheduler.depth, 'queued')
+        yield jobs
 
-            return await ctx.reply(output)
+        rejected = Counter('aperture_snekbox_rejected_jobs_total', 'Eval jobs rejected because the queue was full')
+        rejected.inc(amount=self.scheduler.rejected)
+        yield rejected
+
+        yield HistogramMetric.from_histogram(
+            'aperture_snekbox_queue_wait_seconds', 'Time eval jobs waited for a slot', self.scheduler.queue_wait
+        )
+
+        cache = Counter('aperture_snekbox_cache_lookups_total', 'Eval result cache lookups', ('result', ))
+        cache.inc('hit', amount=self.result_cache.hits)
+        cache.inc('miss', amount=self.result_cache.misses)
+        yield cache
+
+        backends = Gauge('aperture_snekbox_backend_outstanding', 'Jobs in flight on each snekbox backend', ('url', 'state'))
+        for backend in self.backends.backends:
+            backends.set(backend.outstanding, backend.url, backend.state)
+        yield backends
+
+    async def close(self) -> None:
+        self.bot.metrics.remove_collector(self._collect_metrics)
+        await self.backends.close()
+
+    async def _send_result(self, ctx: ApertureContext, result: dict) -> None:
+        response, error = self.get_return_message(result)
+        content = error if error else result['stdout']
+        if result.get('truncated'):
+            response = f'{response} (output truncated to {self.backends.max_bytes} bytes)'
+
+        # Check the length first so the lines are only counted on short outputs
+        # Idk, Just in case, keep the max limit a bit less than 2000
+        if len(response) + len(content) <= 1880 and content.count('\n') < 13:
+            block = '```py\n' + content + '```' if content else '```\n[No Output]```'
+            return await ctx.reply(f'{response}\n\n{block}')
+
+        data = content.encode('utf-8')
+        if len(data) > self.compress_threshold:
+            data = await self.bot.loop.run_in_executor(None, gzip.compress, data)
+            file = discord.File(io.BytesIO(data), filename='output.txt.gz')
+        else:
+            file = discord.File(io.BytesIO(data), filename='output.txt')
+        return await ctx.send(response, file=file)
@@ -17,41 +17,265 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from __future__ import annotations
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import os
 import sys
 import time
+import asyncio
+import hashlib
+import datetime
+import logging
 import aiohttp
+import threading
 import traceback
 
-from discord import Embed, Webhook
+from discord import Embed, HTTPException, Webhook
 
 from aperture.core import ApertureEmbed, ApertureContext
+from aperture.core.tracing import Span, tracer
 
 
 __all__ = ('ApertureManagementWebhookClient', )
 
+log = logging.getLogger(__name__)
+
+
+class RateLimitBucket:
+    """Token bucket allowing ``rate`` sends every ``per`` seconds (in bursts of at most ``rate``)."""
+
+    def __init__(self, rate: int, per: float) -> None:
+        self.rate: int = rate
+        self.per: float = per
+        self.tokens: float = float(rate)
+        self.updated: float = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class ReportChannel:
+    """A webhook with its own bounded queue of reports, sent in background within its rate limits.
+    The reports repeated (or dropped) on the channel are summarized into the same channel."""
+
+    def __init__(self, webhook: Webhook, username: str, *, max_queue: int, rate: int = 5, per: float = 5.0) -> None:
+        self.webhook: Webhook = webhook
+        self.username: str = username
+        self.bucket = RateLimitBucket(rate, per)
+        self.queue: asyncio.Queue[Tuple[Optional[str], List[Embed], Optional[Span]]] = asyncio.Queue(maxsize=max_queue)
+        self.dropped: int = 0
+
+        # fingerprint -> when it was last sent, and the repeats counted since the last summary
+        self.last_reported: Dict[str, float] = {}
+        self.repeats: Dict[str, RepeatedReport] = {}
+
+    def put(self, avatar_url: Optional[str], embeds: List[Embed]) -> bool:
+        try:
+            # The span of the reporting task, so the send shows up in its trace
+            self.queue.put_nowait((avatar_url, embeds, tracer.current_span))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def worker(self) -> None:
+        while True:
+            avatar_url, embeds, parent = await self.queue.get()
+            try:
+                for i in range(0, len(embeds), 10):
+                    await self.bucket.acquire()
+                    with tracer.span('webhook.send', parent=parent, webhook=self.username):
+                        await self.webhook.send(username=self.username, avatar_url=avatar_url, embeds=embeds[i:i+10])
+            except (HTTPException, aiohttp.ClientError) as e:
+                log.error('Failed to send a report to %s: %r', self.username, e)
+            except Exception:
+                # e.g. a malformed embed, the worker must outlive it or every later report is dropped
+                log.exception('Failed to send a report to %s', self.username)
+            finally:
+                self.queue.task_done()
+
+
+class RepeatedReport:
+    __slots__ = ('title', 'count', 'first_id', 'last_id')
+
+    def __init__(self, title: str, exc_id: str) -> None:
+        self.title: str = title
+        self.count: int = 0
+        self.first_id: str = exc_id
+        self.last_id: str = exc_id
+
 
 class ApertureManagementWebhookClient:
-    def __init__(self, session: aiohttp.ClientSession) -> None:
-        self.error_report_webhook = Webhook.from_url(os.getenv('ERROR_REPORT_WEBHOOK'), session=session)
-        self.critical_report_webhook = Webhook.from_url(os.getenv('CRITICAL_REPORT_WEBHOOK'), session=session)
+    """Sends error and critical reports to their webhooks without blocking the failing commands.
+
+    Reports are queued and sent by background workers, following each webhook's rate limit. A report whose
+    fingerprint (the shape of the traceback for errors, the first line for critical reports) was already
+    sent in the last ``dedup_window`` seconds is only counted (its traceback is still printed locally), and the
+    counts are sent as a summary to the same webhook every ``summary_interval`` seconds. Reports are dropped
+    when a queue already holds ``max_queue`` reports.
+    """
+
+    _id_lock = threading.Lock()
+    _last_ms: int = 0
+    _sequence: int = 0
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        *,
+        max_queue: int = 100,
+        summary_interval: float = 60.0,
+        dedup_window: float = 600.0
+    ) -> None:
+        self.error_reports = ReportChannel(
+            Webhook.from_url(os.getenv('ERROR_REPORT_WEBHOOK'), session=session),
+            'Aperture Error Reports', max_queue=max_queue
+        )
+        self.critical_reports = ReportChannel(
+            Webhook.from_url(os.getenv('CRITICAL_REPORT_WEBHOOK'), session=session),
+            'Aperture Critical Reports', max_queue=max_queue
+        )
+        self.summary_interval: float = summary_interval
+        self.dedup_window: float = dedup_window
 
         embed_description_max_limit: int = 4096
         self.prefix: str = '```'
         self.suffix: str = '```'
         self.max_error_length = embed_description_max_limit - (len(self.prefix) + len(self.suffix))
 
+        self._avatar_url: Optional[str] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @classmethod
+    def generate_uuid(cls) -> str:
+        """Returns an ID increasing with time, unique across the processes of this host.
+
+        It's made of the milliseconds since the epoch, a sequence number
+        for the IDs generated in the same millisecond and the process ID."""
+
+        with cls._id_lock:
+            ms = time.time_ns() // 1_000_000
+            if ms <= cls._last_ms:
+                ms, sequence = cls._last_ms, cls._sequence + 1
+                if sequence > 0xFFF:
+                    ms, sequence = ms + 1, 0
+            else:
+                sequence = 0
+            cls._last_ms, cls._sequence = ms, sequence
+        return f'{ms << 12 | sequence:x}-{os.getpid():x}'
+
     @staticmethod
-    def generate_uuid(user_id: int) -> str:
-        return hex(int(str(time.time()).replace('.', '') + str(user_id)))[2:]
+    def fingerprint_exception(error: BaseException) -> str:
+        """Hashes the exception types and the frames of the traceback (and of the chained exceptions),
+        ignoring the messages so the same failure with different values is reported once."""
+
+        shape: List[str] = []
+        current: Optional[BaseException] = error
+        for _ in range(5):
+            if current is None:
+                break
+            shape.append(f'{type(current).__module__}.{type(current).__qualname__}')
+            shape.extend(f'{frame.filename}:{frame.name}:{frame.lineno}' for frame in traceback.extract_tb(current.__traceback__))
+            current = current.__cause__ or current.__context__
+        return hashlib.blake2b('\n'.join(shape).encode(), digest_size=6).hexdigest()
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self.error_reports.worker()),
+            asyncio.create_task(self.critical_reports.worker()),
+            asyncio.create_task(self._summary_loop()),
+        ]
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Sends the pending summary and waits (at most ``timeout`` seconds) for the queued reports."""
+
+        self._send_summaries()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(self.error_reports.queue.join(), self.critical_reports.queue.join()), timeout
+            )
+        except asyncio.TimeoutError:
+            log.warning('Dropped the reports which could not be sent before shutting down')
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _is_repeat(self, channel: ReportChannel, fingerprint: str, exc_id: str, title: str) -> bool:
+        now = time.monotonic()
+        last = channel.last_reported.get(fingerprint)
+        if last is not None and now - last < self.dedup_window:
+            repeat = channel.repeats.setdefault(fingerprint, RepeatedReport(title, exc_id))
+            repeat.count += 1
+            repeat.last_id = exc_id
+            return True
+
+        channel.last_reported[fingerprint] = now
+        return False
+
+    async def _summary_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.summary_interval)
+            try:
+                self._send_summaries()
+
+                expired = time.monotonic() - self.dedup_window
+                for channel in (self.error_reports, self.critical_reports):
+                    channel.last_reported = {fp: at for fp, at in channel.last_reported.items() if at >= expired}
+            except Exception:
+                # The loop must outlive it or the repeats are never summarized again
+                log.exception('Failed to send the repeated reports summaries')
+
+    def _send_summaries(self) -> None:
+        self._send_summary(self.error_reports)
+        self._send_summary(self.critical_reports)
+
+    def _send_summary(self, channel: ReportChannel) -> None:
+        dropped = channel.dropped
+        if not channel.repeats and not dropped:
+            return
+
+        lines: List[str] = []
+        length = 0
+        repeats = sorted(channel.repeats.items(), key=lambda item: item[1].count, reverse=True)
+        for fingerprint, repeat in repeats:
+            line = f'> `{fingerprint}` **{repeat.title}** x{repeat.count} (`{repeat.first_id}` ... `{repeat.last_id}`)'
+            if length + len(line) > 3800:
+                lines.append(f'> ...and {len(repeats) - len(lines)} more')
+                break
+            lines.append(line)
+            length += len(line) + 1
+        if dropped:
+            lines.append(f'> **Dropped reports (queue full):** {dropped}')
+
+        channel.repeats.clear()
+        channel.dropped = 0
+
+        embed = ApertureEmbed(
+            title='Repeated Reports Summary', description='\n'.join(lines), color=0xFFBF7F, timestamp=datetime.datetime.now()
+        )
+        channel.put(self._avatar_url, [embed])
 
     async def send_error_report(self, ctx: ApertureContext, error: Exception) -> str:
-        """Returns the UUID generated for the Case"""
+        """Queues the report and returns the UUID generated for the Case"""
+
+        exc_id = self.generate_uuid()
+        self._avatar_url = ctx.me.display_avatar.url
 
-        exc_id = self.generate_uuid(ctx.author.id)
         exc = f'Ignoring Exception in command {ctx.command}:\n' + ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+        # Only the webhook is deduplicated, every exception ID can be found in the local log
+        print(f'[{exc_id}] {exc}', end='', file=sys.stderr)
+
+        title = f'{type(error).__name__} in command {ctx.command}'
+        if self._is_repeat(self.error_reports, self.fingerprint_exception(error), exc_id, title):
+            return exc_id
+
         chunks: List[str] = [self.prefix + exc[i:i+self.max_error_length] + self.suffix for i in range(0, len(exc), self.max_error_length)]
         embeds: List[Embed] = list()
         attachments_url: str = str('\n>' + ', '.join('`' + attc.url + '`' for attc in ctx.message.attachments)) if ctx.message.attachments else 'None'
@@ -63,6 +287,8 @@ class ApertureManagementWebhookClient:
                 description=f"""
                     > **Exception ID:** `{exc_id}`
 
+                    > **Trace ID:** `{tracer.current_trace_id() or 'Not sampled'}`
+
                     > **Author:** {ctx.author} (`{ctx.author.id}`) - {ctx.author.mention}
 
                     > **Channel:** {ctx.channel} (`{ctx.channel.id}`) - {ctx.channel.mention}
@@ -82,26 +308,24 @@ class ApertureManagementWebhookClient:
         for chunk in chunks:
             embeds.append(ApertureEmbed.default(ctx, description=chunk, color=0xFF7F7F))
 
-        if len(embeds) > 10:
-            for i in range(0, len(embeds), 10):
-                await self.error_report_webhook.send(username='Aperture Error Reports', avatar_url=ctx.me.display_avatar.url, embeds=embeds[i:i+10])
-
-        else:
-            await self.error_report_webhook.send(username='Aperture Error Reports', avatar_url=ctx.me.display_avatar.url, embeds=embeds)
-
-        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        self.error_reports.put(self._avatar_url, embeds)
         return exc_id
 
     async def send_critical_report(self, ctx: ApertureContext, message: str):
+        """Queues the report"""
+
+        self._avatar_url = ctx.me.display_avatar.url
+        title = message.split('\n', 1)[0][:100]
+        fingerprint = hashlib.blake2b(title.encode(), digest_size=6).hexdigest()
+        if self._is_repeat(self.critical_reports, fingerprint, self.generate_uuid(), title):
+            return
+
         embeds: List[Embed] = list()
         chunks: List[str] = [message[i:i+4000] for i in range(0, len(message), 4000)] # A bit less than 4096
 
         for chunk in chunks:
             embeds.append(ApertureEmbed.default(ctx, title='Critical Report', description=chunk, color=0xFF0000))
+        if (trace_id := tracer.current_trace_id()) is not None:
+            embeds[-1].set_footer(text=f'Trace ID: {trace_id}')
 
-        if len(embeds) > 10:
-            for i in range(0, len(embeds), 10):
-                await self.critical_report_webhook.send(username='Aperture Critical Reports', avatar_url=ctx.me.display_avatar.url, embeds=embeds[i:i+10])
-
-        else:
-            await self.critical_report_webhook.send(username='Aperture Critical Reports', avatar_url=ctx.me.display_avatar.url, embeds=embeds)
+        self.critical_reports.put(self._avatar_url, embeds)
@@ -0,0 +1,87 @@
+"""
+Measures how message throughput scales with the number of cluster workers, using a stubbed gateway.
+
+Each worker decodes synthetic MESSAGE_CREATE payloads for its shards and runs them through the
+per-message hot path (prefix resolution and blacklist checks), without connecting to Discord.
+
+Run from the repository root with: ``python -m benchmarks.cluster_scaling``
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, Tuple
+
+import os
+import json
+import time
+import queue
+import random
+import functools
+import multiprocessing
+
+from launcher import ClusterSupervisor
+
+
+DURATION: float = 5.0
+
+
+def stub_gateway_worker(results: Any, worker_id: int, shard_ids: List[int], shard_count: int, log_queue: Any) -> None:
+    from aperture.core.cache.prefix import compile_prefix
+    from aperture.core.cache.snowflake_set import SnowflakeSet
+
+    blacklist = SnowflakeSet()
+    blacklist.update(random.sample(range(10 ** 17, 10 ** 18), 10_000))
+    matchers = [compile_prefix(prefix) for prefix in ('ap!', 'AP?', '>>', 'aperture ')]
+
+    payloads: List[bytes] = []
+    for i in range(1024):
+        guild_id = random.randrange(10 ** 17, 10 ** 18)
+        if (guild_id >> 22) % shard_count not in shard_ids:
+            continue
+        content = random.choice(('ap!help', 'hello there', 'Ap!eval print(1)', 'lorem ipsum ' * 10))
+        payloads.append(json.dumps({
+            'op': 0, 't': 'MESSAGE_CREATE', 's': i,
+            'd': {'id': str(i), 'guild_id': str(guild_id), 'content': content, 'author': {'id': str(guild_id + 1)}}
+        }).encode())
+
+    count = 0
+    started = last_report = time.perf_counter()
+    while True:
+        for raw in payloads:
+            data = json.loads(raw)['d']
+            if int(data['author']['id']) in blacklist or int(data['guild_id']) in blacklist:
+                continue
+            matchers[count & 3].resolve(data['content'])
+            count += 1
+
+        now = time.perf_counter()
+        if now - last_report >= 0.5:
+            results.put((worker_id, count, now - started))
+            last_report = now
+
+
+def main() -> None:
+    context = multiprocessing.get_context('spawn')
+    print(f'{"workers":>7} | {"messages/s":>12} | {"per worker":>12}')
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        results = context.Queue()
+        supervisor = ClusterSupervisor(
+            workers, workers * 2, target=functools.partial(stub_gateway_worker, results)
+        )
+        supervisor.run(poll_interval=0.1, duration=DURATION)
+
+        latest: Dict[int, Tuple[int, float]] = {}
+        while True:
+            try:
+                worker_id, count, elapsed = results.get(timeout=0.5)
+            except queue.Empty:
+                break
+            latest[worker_id] = (count, elapsed)
+
+        rate = sum(count / elapsed for count, elapsed in latest.values())
+        print(f'{workers:>7} | {rate:>12,.0f} | {rate / workers:>12,.0f}')
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
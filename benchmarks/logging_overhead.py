@@ -0,0 +1,62 @@
+"""
+Measures the time the logging thread (the event loop in the bot) spends per debug record with
+the file handler written inline, through the background listener, and with sampling on top.
+
+Run from the repository root with: ``python -m benchmarks.logging_overhead``
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import asyncio
+import logging
+import tempfile
+
+from aperture.core.logging import ApertureLogger
+
+
+RECORDS: int = 50_000
+
+
+async def log_commands(log: logging.Logger) -> float:
+    """Logs like ``listeners.on_command`` does, yielding to the loop every 100 records.
+    Returns the time spent in the logging calls."""
+
+    spent = 0.0
+    for i in range(RECORDS):
+        start = time.perf_counter()
+        log.debug('Command %s invoked by %s in %s', 'eval', 1234567890 + i, 9876543210)
+        spent += time.perf_counter() - start
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    return spent
+
+
+def main() -> None:
+    modes = (
+        ('inline', {'background': False}),
+        ('background', {'background': True}),
+        ('background+json', {'background': True, 'json_output': True}),
+        ('background+sampled', {'background': True, 'sampling': 'aperture.core.listeners=1000/1'}),
+    )
+    log = logging.getLogger('aperture.core.listeners')
+
+    print(f'{"mode":>18} | {"loop us/record":>14} | {"total incl. drain (s)":>21}')
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        os.mkdir('tmp')
+        try:
+            for name, kwargs in modes:
+                total_start = time.perf_counter()
+                with ApertureLogger(log_discord=False, enable_bot_debug=True, **kwargs):
+                    spent = asyncio.run(log_commands(log))
+                total = time.perf_counter() - total_start
+                print(f'{name:>18} | {spent / RECORDS * 1e6:>14.2f} | {total:>21.2f}')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Compares list backed and set backed blacklist/premium membership checks.
+
+Run from the repository root with: ``python -m benchmarks.membership``
+"""
+
+from __future__ import annotations
+
+import random
+import timeit
+
+from aperture.core.cache.snowflake_set import SnowflakeSet, SnowflakeSetUnion
+
+
+NUMBER: int = 100
+
+
+def main() -> None:
+    print(f'{"ids":>9} | {"list in (us)":>12} | {"set in (us)":>11} | {"list all (us)":>13} | {"view all (us)":>13}')
+    for size in (1_000, 100_000, 1_000_000):
+        guild_ids = random.sample(range(10 ** 17, 10 ** 18), size)
+        user_ids = random.sample(range(10 ** 17, 10 ** 18), size)
+        missing = 1 # Worst case for a list: scan everything
+
+        guilds_list, users_list = list(guild_ids), list(user_ids)
+        guilds, users = SnowflakeSet(), SnowflakeSet()
+        guilds.update(guild_ids)
+        users.update(user_ids)
+        view = SnowflakeSetUnion(guilds, users)
+
+        list_in = timeit.timeit(lambda: missing in users_list, number=NUMBER) / NUMBER * 1e6
+        set_in = timeit.timeit(lambda: missing in users, number=NUMBER) / NUMBER * 1e6
+        # ``Premium.all`` used to concatenate both lists before every membership check
+        list_all = timeit.timeit(lambda: missing in guilds_list + users_list, number=NUMBER) / NUMBER * 1e6
+        view_all = timeit.timeit(lambda: missing in view, number=NUMBER) / NUMBER * 1e6
+        print(f'{size:>9} | {list_in:>12.2f} | {set_in:>11.2f} | {list_all:>13.2f} | {view_all:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Compares the compiled prefix matcher with the old ``itertools.product`` prefix expansion.
+
+Run from the repository root with: ``python -m benchmarks.prefix_matching``
+"""
+
+from __future__ import annotations
+from typing import List
+
+import itertools
+import string
+import random
+import timeit
+
+from aperture.core.cache.prefix import PrefixMatcher
+
+
+NUMBER: int = 2_000
+
+
+def old_prefixes(prefix: str) -> List[str]:
+    return list(map(''.join, itertools.product(*zip(prefix.lower(), prefix.upper()))))
+
+def old_path(prefix: str, content: str) -> str:
+    # What the bot (and discord.py's get_context) did for every message
+    prefixes = old_prefixes(prefix)
+    for candidate in prefixes:
+        if content.startswith(candidate):
+            return candidate
+    return prefix
+
+def main() -> None:
+    print(f'{"length":>6} | {"candidates":>10} | {"old (us)":>10} | {"matcher (us)":>12} | {"speedup":>8}')
+    for length in range(1, 11):
+        prefix = ''.join(random.choices(string.ascii_lowercase, k=length))
+        content = prefix.swapcase() + 'help snekbox'
+        matcher = PrefixMatcher(prefix)
+
+        assert old_path(prefix, content) == matcher.resolve(content)
+
+        old = timeit.timeit(lambda: old_path(prefix, content), number=NUMBER) / NUMBER * 1e6
+        new = timeit.timeit(lambda: matcher.resolve(content), number=NUMBER) / NUMBER * 1e6
+        print(f'{length:>6} | {2 ** length:>10} | {old:>10.2f} | {new:>12.2f} | {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Runs eval jobs through the snekbox load balancer against local stub servers: a fast one,
+a slow one and one failing after a while, and prints how the jobs were spread.
+
+Run from the repository root with: ``python -m benchmarks.snekbox_balancer``
+"""
+
+from __future__ import annotations
+from typing import List, Tuple
+
+import time
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from aperture.extensions.useful.backends import NoSnekboxBackend, SnekboxBackends
+
+
+JOBS: int = 500
+CONCURRENCY: int = 32
+
+
+def make_stub(delay: float, fail_after: int = -1) -> web.Application:
+    served = 0
+
+    async def evaluate(request: web.Request) -> web.Response:
+        nonlocal served
+        served += 1
+        if 0 <= fail_after < served:
+            return web.json_response({'stdout': '', 'returncode': None}, status=503)
+        payload = await request.json()
+        await asyncio.sleep(delay)
+        return web.json_response({'stdout': payload['input'], 'returncode': 0})
+
+    async def probe(_: web.Request) -> web.Response:
+        return web.Response(status=405 if fail_after < 0 or served <= fail_after else 503)
+
+    app = web.Application()
+    app.router.add_post('/eval', evaluate)
+    app.router.add_get('/eval', probe)
+    return app
+
+
+async def start_stubs(stubs: List[Tuple[str, web.Application]]) -> Tuple[List[web.AppRunner], List[str]]:
+    runners, urls = [], []
+    for _, app in stubs:
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        runners.append(runner)
+        urls.append(f'http://127.0.0.1:{port}/eval')
+    return runners, urls
+
+
+async def main() -> None:
+    stubs = [
+        ('fast', make_stub(0.01)),
+        ('slow', make_stub(0.10)),
+        ('failing', make_stub(0.01, fail_after=50)),
+    ]
+    runners, urls = await start_stubs(stubs)
+    backends = SnekboxBackends(urls, failure_threshold=3, cooldown=1.0, probe_interval=0.5)
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    failed = 0
+
+    async def job(i: int) -> None:
+        nonlocal failed
+        async with semaphore:
+            try:
+                await backends.post(session, {'input': f'print({i})'})
+            except NoSnekboxBackend:
+                failed += 1
+
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(job(i) for i in range(JOBS)))
+        elapsed = time.perf_counter() - start
+        await backends.close()
+
+    for runner in runners:
+        await runner.cleanup()
+
+    print(f'{JOBS} jobs in {elapsed:.2f}s, {failed} failed on every backend')
+    print(f'{"backend":>8} | {"requests":>8} | {"errors":>6} | {"state":>9} | {"p50 (ms)":>8} | {"p99 (ms)":>8}')
+    for (name, _), stats in zip(stubs, backends.stats()):
+        latency = stats['latency']
+        print(f'{name:>8} | {stats["requests"]:>8} | {stats["errors"]:>6} | {stats["state"]:>9} | '
+              f'{(latency["p50"] or 0) * 1000:>8.1f} | {(latency["p99"] or 0) * 1000:>8.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
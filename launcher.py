@@ -2,10 +2,15 @@ from __future__ import annotations
 
 import os
 import sys
+import time
+import signal
 import logging
 import asyncio
+import argparse
+import multiprocessing
+from logging.handlers import QueueListener
 from dotenv import load_dotenv
-from typing import Literal, NamedTuple
+from typing import Any, Callable, Dict, List, Literal, NamedTuple, Optional, Sequence
 
 from aperture import ApertureBot
 from aperture.core import ApertureLogger, ApertureDatabase, ApertureCache
@@ -29,9 +34,14 @@ class VersionInfo(NamedTuple):
 __version__: str = '1.0.1a'
 
 
-def run_bot() -> None:
-    with ApertureLogger(log_discord=True, enable_bot_debug=True):
-        bot = ApertureBot()
+def run_bot(
+    shard_ids: Optional[Sequence[int]] = None,
+    shard_count: Optional[int] = None,
+    log_queue: Optional[Any] = None,
+    worker_id: Optional[int] = None
+) -> None:
+    with ApertureLogger(log_discord=True, enable_bot_debug=True, queue=log_queue, worker_id=worker_id):
+        bot = ApertureBot(shard_ids=shard_ids, shard_count=shard_count, worker_id=worker_id)
         bot.version_info = VersionInfo(major=1, minor=0, micro=1, releaselevel='alpha', serial=0)
 
         bot.database = ApertureDatabase()
@@ -41,5 +51,128 @@ def run_bot() -> None:
         bot.run(os.getenv('BOT_TOKEN'), version=__version__)
 
 
+# Cluster mode
+
+# (worker_id, shard_ids, shard_count, log_queue)
+WorkerTarget = Callable[[int, List[int], int, Any], None]
+
+
+def run_worker(worker_id: int, shard_ids: List[int], shard_count: int, log_queue: Any) -> None:
+    run_bot(shard_ids=shard_ids, shard_count=shard_count, log_queue=log_queue, worker_id=worker_id)
+
+
+def split_shards(shard_count: int, workers: int) -> List[List[int]]:
+    """Splits the shards into ``workers`` contiguous ranges of (almost) equal size."""
+
+    size, remainder = divmod(shard_count, workers)
+    ranges: List[List[int]] = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (1 if i < remainder else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class ClusterSupervisor:
+    """Runs ``workers`` processes, each one running an auto-sharded bot over a contiguous range of shards.
+
+    Every worker has its own database pool and cache. Crashed workers are restarted with an exponential
+    backoff, and the logs of all workers are written by the supervisor's handlers through a queue.
+    ``target`` can be replaced (e.g. with a stubbed gateway) to run the cluster without connecting to Discord.
+    """
+
+    def __init__(self, workers: int, shard_count: int, *, target: WorkerTarget = run_worker) -> None:
+        if workers < 1 or shard_count < workers:
+            raise ValueError('Expected at least one worker and at least one shard per worker')
+
+        self.workers: int = workers
+        self.shard_count: int = shard_count
+        self.target: WorkerTarget = target
+
+        self.context = multiprocessing.get_context('spawn')
+        self.log_queue = self.context.Queue()
+        self.shard_ranges: List[List[int]] = split_shards(shard_count, workers)
+        self.processes: Dict[int, multiprocessing.process.BaseProcess] = {}
+
+        self._started_at: Dict[int, float] = {}
+        self._backoff: Dict[int, float] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._stopping: bool = False
+
+    def _spawn(self, worker_id: int) -> None:
+        process = self.context.Process(
+            target=self.target,
+            args=(worker_id, self.shard_ranges[worker_id], self.shard_count, self.log_queue),
+            name=f'aperture-worker-{worker_id}',
+            daemon=False,
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+        log.info('Started worker %s (PID: %s) for shards %s', worker_id, process.pid, self.shard_ranges[worker_id])
+
+    def _check_workers(self) -> None:
+        now = time.monotonic()
+        for worker_id, process in self.processes.items():
+            if process.is_alive():
+                continue
+
+            restart_at = self._restart_at.get(worker_id)
+            if restart_at is None:
+                # Reset the backoff if the worker ran long enough before dying
+                backoff = 1.0 if now - self._started_at[worker_id] > 60 else min(self._backoff.get(worker_id, 0.5) * 2, 60.0)
+                self._backoff[worker_id] = backoff
+                self._restart_at[worker_id] = now + backoff
+                log.warning('Worker %s exited with code %s, restarting in %ss', worker_id, process.exitcode, backoff)
+            elif now >= restart_at:
+                del self._restart_at[worker_id]
+                self._spawn(worker_id)
+
+    def stop(self, *_: Any) -> None:
+        self._stopping = True
+
+    def run(self, *, poll_interval: float = 1.0, duration: Optional[float] = None) -> None:
+        """Runs until a SIGINT/SIGTERM is received (or ``duration`` seconds have passed)."""
+
+        listener = QueueListener(self.log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        deadline = time.monotonic() + duration if duration is not None else None
+        try:
+            while not self._stopping and (deadline is None or time.monotonic() < deadline):
+                self._check_workers()
+                time.sleep(poll_interval)
+        finally:
+            log.info('Stopping %s workers', len(self.processes))
+            for process in self.processes.values():
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes.values():
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.kill()
+            listener.stop()
+
+
+def run_cluster(workers: int, shard_count: int) -> None:
+    with ApertureLogger(log_discord=True, enable_bot_debug=True):
+        ClusterSupervisor(workers, shard_count).run()
+
+
 if __name__ == '__main__':
-    run_bot()
+    parser = argparse.ArgumentParser(description='Run Aperture')
+    parser.add_argument('--workers', type=int, default=0, help='Run in cluster mode with this many worker processes')
+    parser.add_argument('--shards', type=int, default=None, help='Total shard count in cluster mode (default: one per worker)')
+    options = parser.parse_args()
+
+    if options.workers:
+        run_cluster(options.workers, options.shards or options.workers)
+    else:
+        run_bot()
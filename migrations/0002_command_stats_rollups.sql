@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS "command_stats_minutely" (
+    "bucket" TIMESTAMP WITH TIME ZONE NOT NULL,
+    "name" VARCHAR(20) NOT NULL,
+    "type" SMALLINT NOT NULL,
+    "guild_id" BIGINT NOT NULL DEFAULT 0,
+    "uses" INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY ("bucket", "name", "type", "guild_id")
+);
+
+CREATE TABLE IF NOT EXISTS "command_stats_hourly" (
+    "bucket" TIMESTAMP WITH TIME ZONE NOT NULL,
+    "name" VARCHAR(20) NOT NULL,
+    "type" SMALLINT NOT NULL,
+    "guild_id" BIGINT NOT NULL DEFAULT 0,
+    "uses" INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY ("bucket", "name", "type", "guild_id")
+);
@@ -0,0 +1,32 @@
+CREATE OR REPLACE FUNCTION "notify_cache_invalidation"() RETURNS TRIGGER AS $$
+DECLARE
+    "row" RECORD;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        "row" := OLD;
+    ELSE
+        "row" := NEW;
+    END IF;
+
+    PERFORM pg_notify(
+        'aperture_cache_invalidation',
+        json_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'row', row_to_json("row"))::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS "prefixes_cache_invalidation" ON "prefixes";
+CREATE TRIGGER "prefixes_cache_invalidation"
+    AFTER INSERT OR UPDATE OR DELETE ON "prefixes"
+    FOR EACH ROW EXECUTE PROCEDURE "notify_cache_invalidation"();
+
+DROP TRIGGER IF EXISTS "guilds_core_cache_invalidation" ON "guilds_core";
+CREATE TRIGGER "guilds_core_cache_invalidation"
+    AFTER INSERT OR UPDATE OR DELETE ON "guilds_core"
+    FOR EACH ROW EXECUTE PROCEDURE "notify_cache_invalidation"();
+
+DROP TRIGGER IF EXISTS "users_core_cache_invalidation" ON "users_core";
+CREATE TRIGGER "users_core_cache_invalidation"
+    AFTER INSERT OR UPDATE OR DELETE ON "users_core"
+    FOR EACH ROW EXECUTE PROCEDURE "notify_cache_invalidation"();
@@ -0,0 +1,83 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import unittest
+
+from aperture.core.cache.single_flight import SingleFlight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_are_coalesced(self) -> None:
+        flight: SingleFlight[int] = SingleFlight()
+        calls = 0
+
+        async def func() -> int:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 42
+
+        results = await asyncio.gather(*(flight.do('key', func) for _ in range(5)))
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(calls, 1)
+        self.assertEqual(len(flight), 0)
+
+    async def test_leader_cancellation_reruns_for_followers(self) -> None:
+        flight: SingleFlight[int] = SingleFlight()
+        calls = 0
+
+        async def func() -> int:
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return calls
+
+        leader = asyncio.create_task(flight.do('key', func))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do('key', func)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+
+        # The followers weren't cancelled, one of them runs the call again for all of them
+        self.assertEqual(await asyncio.gather(*followers), [2, 2, 2])
+        self.assertEqual(calls, 2)
+
+    async def test_follower_cancellation_is_not_swallowed(self) -> None:
+        flight: SingleFlight[int] = SingleFlight()
+
+        async def func() -> int:
+            await asyncio.sleep(0.05)
+            return 1
+
+        leader = asyncio.create_task(flight.do('key', func))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do('key', func))
+        await asyncio.sleep(0.01)
+
+        follower.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await follower
+        self.assertEqual(await leader, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Aperture - A Multi-Purpose Discord Bot
+Copyright (C) 2021-present  AkshuAgarwal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import types
+import unittest
+
+from aperture import ApertureBot
+from aperture.core.timings import PipelineTimings
+
+
+class TimingsToggleTest(unittest.IsolatedAsyncioTestCase):
+    def make_bot(self) -> types.SimpleNamespace:
+        bot = types.SimpleNamespace(
+            pipeline_timings=None,
+            _timing_hooks=None,
+            _before_invoke=None,
+            _after_invoke=None,
+            _chain_hooks=ApertureBot._chain_hooks,
+            _timings_before_invoke=ApertureBot._timings_before_invoke,
+            _timings_after_invoke=ApertureBot._timings_after_invoke,
+        )
+        bot.enable_timings = types.MethodType(ApertureBot.enable_timings, bot)
+        bot.disable_timings = types.MethodType(ApertureBot.disable_timings, bot)
+        return bot
+
+    async def test_disable_from_a_timed_invocation(self) -> None:
+        bot = self.make_bot()
+        bot.enable_timings()
+        timings = bot.pipeline_timings
+        command = types.SimpleNamespace(qualified_name='timings')
+        ctx = types.SimpleNamespace(command=command, timings=None)
+
+        async def get_context(message, *, cls):
+            return ctx
+
+        async def pre_checks(ctx):
+            return True
+
+        async def invoke_measured(ctx):
+            # What ``timings off`` does
+            bot.disable_timings()
+
+        bot.get_context, bot._pre_checks, bot._invoke_measured = get_context, pre_checks, invoke_measured
+        await ApertureBot._process_commands(bot, object())
+
+        self.assertIsNone(bot.pipeline_timings)
+        self.assertIn('timings', timings.histograms)
+
+    async def test_previous_hooks_are_kept(self) -> None:
+        bot = self.make_bot()
+        calls = []
+
+        async def before(ctx):
+            calls.append('before')
+
+        bot._before_invoke = before
+        bot.enable_timings()
+        self.assertIsInstance(bot.pipeline_timings, PipelineTimings)
+        await bot._before_invoke(types.SimpleNamespace(timings=None))
+        self.assertEqual(calls, ['before'])
+
+        bot.disable_timings()
+        self.assertIs(bot._before_invoke, before)
+        self.assertIsNone(bot._after_invoke)
+
+
+if __name__ == '__main__':
+    unittest.main()